@@ -0,0 +1,83 @@
+# /*
+#  * Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#  * SPDX-License-Identifier: MIT-0
+#  *
+#  * Permission is hereby granted, free of charge, to any person obtaining a copy of this
+#  * software and associated documentation files (the "Software"), to deal in the Software
+#  * without restriction, including without limitation the rights to use, copy, modify,
+#  * merge, publish, distribute, sublicense, and/or sell copies of the Software, and to
+#  * permit persons to whom the Software is furnished to do so.
+#  *
+#  * THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+#  * INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A
+#  * PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+#  * HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+#  * OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+#  * SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+#  */
+
+# Benchmark of the cold-start import cost of every Lambda handler, with the shared layer on the path as in the
+# deployed functions. Each handler is imported in a fresh interpreter. LedgerNameString is left unset so that no
+# driver is pre-warmed, only the import cost is measured.
+#
+# Usage: python benchmarks/import_time.py [runs]
+
+import json
+import os
+import subprocess
+import sys
+from statistics import median
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+LAMBDA_DIRECTORY = os.path.join(ROOT, 'lambda')
+SHARED_DIRECTORY = os.path.join(ROOT, 'sharedFiles', 'python')
+HEAVY_MODULES = ('boto3', 'botocore', 'pyqldb', 'amazon.ion')
+
+PROBE = '''
+import json, sys, time
+started = time.perf_counter()
+import lambda_function
+elapsed_ms = (time.perf_counter() - started) * 1000
+print(json.dumps({'ms': elapsed_ms, 'loaded': [name for name in %r if name in sys.modules]}))
+''' % (HEAVY_MODULES,)
+
+
+def get_handlers():
+    return sorted(name for name in os.listdir(LAMBDA_DIRECTORY)
+                  if os.path.isfile(os.path.join(LAMBDA_DIRECTORY, name, 'lambda_function.py')))
+
+
+def import_handler(name):
+    env = dict(os.environ)
+    env.pop('LedgerNameString', None)
+    env.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+    env['PYTHONPATH'] = os.pathsep.join([os.path.join(LAMBDA_DIRECTORY, name), SHARED_DIRECTORY])
+    env['PYTHONDONTWRITEBYTECODE'] = '1'
+    result = subprocess.run([sys.executable, '-c', PROBE], env=env, capture_output=True, text=True,
+                            cwd=os.path.join(LAMBDA_DIRECTORY, name))
+    if result.returncode != 0:
+        return None, result.stderr.strip().splitlines()[-1]
+    return json.loads(result.stdout.strip().splitlines()[-1]), None
+
+
+def main():
+    runs = int(sys.argv[1]) if len(sys.argv) > 1 else 5
+    print('{:<20} {:>12} {:>12}  {}'.format('handler', 'median ms', 'max ms', 'heavy modules loaded'))
+    for name in get_handlers():
+        timings = []
+        loaded = []
+        error = None
+        for _ in range(runs):
+            result, error = import_handler(name)
+            if result is None:
+                break
+            timings.append(result['ms'])
+            loaded = result['loaded']
+        if error is not None:
+            print('{:<20} {}'.format(name, error))
+            continue
+        print('{:<20} {:>12.1f} {:>12.1f}  {}'.format(name, median(timings), max(timings), ', '.join(loaded) or '-'))
+
+
+if __name__ == '__main__':
+    main()
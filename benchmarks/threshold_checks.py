@@ -0,0 +1,95 @@
+# /*
+#  * Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#  * SPDX-License-Identifier: MIT-0
+#  *
+#  * Permission is hereby granted, free of charge, to any person obtaining a copy of this
+#  * software and associated documentation files (the "Software"), to deal in the Software
+#  * without restriction, including without limitation the rights to use, copy, modify,
+#  * merge, publish, distribute, sublicense, and/or sell copies of the Software, and to
+#  * permit persons to whom the Software is furnished to do so.
+#  *
+#  * THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+#  * INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A
+#  * PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+#  * HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+#  * OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+#  * SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+#  */
+
+# Benchmark of coldchain threshold checks for items per package x readings per batch: the per-row loop over Ion
+# query results against a per-reading check on the columns of sharedFiles/python/thresholds.py, with and without
+# NumPy, and the lowest/highest reading check that sensorUpdate runs.
+#
+# Usage: python benchmarks/threshold_checks.py
+
+import os
+import sys
+from decimal import Decimal
+from random import Random
+from timeit import Timer
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'sharedFiles', 'python'))
+
+from amazon.ion.simpleion import dumps, loads
+import thresholds
+from thresholds import ReadingBuffer, ThresholdTable
+
+ITEM_COUNTS = (10, 100, 1000)
+READING_COUNTS = (10, 100, 1000)
+
+
+def make_rows(item_count, random):
+    # Rows shaped like the Item query results of sensorUpdate, with Ion decimal limits
+    return loads(dumps([{'id': 'doc{}'.format(index),
+                         'MinTemperature': Decimal(random.randint(0, 4)),
+                         'MaxTemperature': Decimal(random.randint(6, 10))} for index in range(item_count)]))
+
+
+def ion_row_loop(rows, temperatures):
+    return [[temperature > row['MaxTemperature'] or temperature < row['MinTemperature'] for row in rows]
+            for temperature in temperatures]
+
+
+def violation_mask(table, readings):
+    # Which item every reading violates, a readings x items matrix checked on the columns of the threshold table
+    numpy = thresholds.get_numpy()
+    if numpy is not None:
+        temperatures = numpy.frombuffer(readings.temperatures, dtype=numpy.float64)[:, numpy.newaxis]
+        return (temperatures > numpy.frombuffer(table.max_limits, dtype=numpy.float64)) | \
+               (temperatures < numpy.frombuffer(table.min_limits, dtype=numpy.float64))
+    limits = list(zip(table.min_limits, table.max_limits))
+    return [[temperature > max_limit or temperature < min_limit for min_limit, max_limit in limits]
+            for temperature in readings.temperatures]
+
+
+def best_time(function):
+    timer = Timer(function)
+    number, _ = timer.autorange()
+    return min(timer.repeat(repeat=3, number=number)) / number
+
+
+def main():
+    random = Random(42)
+    numpy_module = thresholds.get_numpy()
+    print('{:>6} {:>9} {:>12} {:>12} {:>12} {:>12}'.format('items', 'readings', 'ion loop ms', 'array ms',
+                                                          'numpy ms', 'min/max ms'))
+    for item_count in ITEM_COUNTS:
+        rows = make_rows(item_count, random)
+        for reading_count in READING_COUNTS:
+            temperatures = [random.uniform(-1, 11) for _ in range(reading_count)]
+            readings = ReadingBuffer(temperatures)
+            table = ThresholdTable.from_rows(rows)
+            ion_ms = best_time(lambda: ion_row_loop(rows, temperatures)) * 1000
+            thresholds._numpy = False
+            array_ms = best_time(lambda: violation_mask(table, readings)) * 1000
+            thresholds._numpy = numpy_module
+            numpy_ms = best_time(lambda: violation_mask(table, readings)) * 1000 if numpy_module is not None else None
+            # The items violated by any reading of the batch, as sensorUpdate computes them
+            range_ms = best_time(lambda: table.violating_ids(readings.min(), readings.max())) * 1000
+            print('{:>6} {:>9} {:>12.3f} {:>12.3f} {:>12} {:>12.3f}'.format(
+                item_count, reading_count, ion_ms, array_ms,
+                'n/a' if numpy_ms is None else '{:.3f}'.format(numpy_ms), range_ms))
+
+
+if __name__ == '__main__':
+    main()
@@ -18,36 +18,36 @@
 
 # Validate functionality for journal transactions
 
-from time import sleep
-from datetime import datetime
-from decimal import Decimal
-from boto3 import client
-from common import convert_object_to_ion, block_address_to_dictionary, create_qldb_driver
-from verifier import verify_document
-from pyqldb.driver.qldb_driver import QldbDriver
-from base64 import encode, decode, b64encode, b64decode
+from common import block_address_to_dictionary, pooled_qldb_driver, prewarm_qldb_driver, fetch_all, TokenBucket, \
+    to_base_64, DigestProvider, block_address_key, get_qldb_client, StatementTracer
+from checkpoint import create_checkpoint_store, DigestCheckpoint
+from constants import Constants
+from verifier import verify_documents, parse_block_contents
+from base64 import b64decode
 import json
 from amazon.ion.simpleion import loads
 import os
+import uuid
+from time import time
 
-qldb_client = client('qldb')
+qldb_client = get_qldb_client()
 
 ledger_name = os.environ.get('LedgerNameString')
+statement_tracer = StatementTracer.from_environment('dataValidation')
+prewarm_qldb_driver(ledger_name)
+proof_fetch_concurrency = int(os.environ.get('ProofFetchConcurrency', Constants.PROOF_FETCH_CONCURRENCY))
+# Shared across warm invocations so the request rate stays adapted to QLDB throttling
+proof_fetch_limiter = TokenBucket(float(os.environ.get('ProofFetchRate', Constants.PROOF_FETCH_RATE_PER_SEC)))
+verification_job_slice_size = int(os.environ.get('VerificationJobSliceSize', Constants.VERIFICATION_JOB_SLICE_SIZE))
+verification_job_time_margin_ms = int(os.environ.get('VerificationJobTimeMarginMs', Constants.VERIFICATION_JOB_TIME_MARGIN_MS))
+verification_job_ttl_sec = int(os.environ.get('VerificationJobTtlSec', Constants.VERIFICATION_JOB_TTL_SEC))
+digest_provider = DigestProvider.from_environment(qldb_client, ledger_name)
+# Revisions verified by earlier audits stay trusted as long as newer digests are proven to extend this checkpoint
+digest_checkpoint = DigestCheckpoint(create_checkpoint_store(), 'trusted-digest-{}'.format(ledger_name), qldb_client,
+                                     ledger_name)
 
-def get_digest_result(name):
-    """
-    Get the digest of a ledger's journal.
-
-    :type name: str
-    :param name: Name of the ledger to operate on.
-
-    :rtype: dict
-    :return: The digest in a 256-bit hash value and a block address.
-    """
-    print("Let's get the current digest of the ledger named {}".format(name))
-    result = qldb_client.get_digest(Name=name)
-    print(result)
-    return result
+REVISION_MODE = 'Revision'
+BLOCK_MODE = 'Block'
 
 def get_revision(ledger_name, document_id, block_address, digest_tip_address):
     """
@@ -73,190 +73,545 @@ def get_revision(ledger_name, document_id, block_address, digest_tip_address):
                                       DigestTipAddress=digest_tip_address)
     return result
 
-def verify_coldchain(driver, ledger_name, package, batch):
-    print('Starting coldchain verification..')
-    output = ""
-    status = False 
-    # Get the current tip of journal in the ledger
-    current_tip = get_digest_result(ledger_name)
-    digest_bytes = current_tip.get('Digest')
-    
-    digestblock_address = current_tip.get('DigestTipAddress')
-    
-    print('Fetching all items with revision when coldchain was activated for package - {} and batch - {}, and verifying coldchain revisions on each one by one ..'.format(package, batch))
-    
-    statement = "SELECT r.metadata.id As id, r.blockAddress AS blockAddress FROM history(Item) AS r WHERE r.data.PackageLabel = '{}' AND r.data.ItemSpecifications.MfgBatchNumber = '{}' AND r.data.PackageChain.Status = 'Activated'".format(package, batch)
-    print(statement)
-    cursor = driver.execute_lambda(lambda executor: executor.execute_statement(statement))
-    
-    for doc in cursor:
-        document_block_address = doc['blockAddress']
-        document_id = doc['id']
-        
-        result = get_revision(ledger_name, document_id, block_address_to_dictionary(document_block_address), digestblock_address)
-        
+def verify_revisions(ledger_name, docs, digest_bytes, digest_tip_address):
+    """
+    Fetch the revision and proof of each history row and verify all of them against the same digest.
+
+    :type ledger_name: str
+    :param ledger_name: Name of the ledger containing the documents.
+
+    :type docs: list
+    :param docs: History rows holding the document `id` and `blockAddress`.
+
+    :type digest_bytes: bytes
+    :param digest_bytes: The ledger digest to verify against.
+
+    :type digest_tip_address: dict
+    :param digest_tip_address: The latest block location covered by the digest.
+
+    :rtype: list
+    :return: A list of (document_id, verified) tuples in row order.
+    """
+    document_ids = [doc['id'] for doc in docs]
+    requests = [(ledger_name, doc['id'], block_address_to_dictionary(doc['blockAddress']), digest_tip_address)
+                for doc in docs]
+    document_proofs = []
+    for result in fetch_all(get_revision, requests, proof_fetch_concurrency, proof_fetch_limiter):
         revision = result.get('Revision').get('IonText')
-            
-        document_hash = loads(revision).get('hash')
-           
-        proof = result.get('Proof')
-            
-        try:
-            verified = verify_document(document_hash, digest_bytes, proof)
-            if not verified:
-                print('Document revision is not verified, data compromised - {}'.format(document_id))
-                print('Aborting rest of the verification chain..')
-                status = False
-                return status
-            else:
-                print('Success! Coldchain verified for document - {}'. format(document_id))
-                status = True
-            
-            # Fetch latest revision coldchain status to report 
-            statement1 = "SELECT r.data.ItemId As id, r.data.PackageChain.Status As status FROM _ql_committed_Item AS r WHERE r.data.PackageLabel = '{}' AND r.data.ItemSpecifications.MfgBatchNumber = '{}' AND r.metadata.id = '{}'".format(package, batch, document_id)
-            print(statement1)
-            cursor1 = driver.execute_lambda(lambda executor: executor.execute_statement(statement1))
-            for docn in cursor1:
-                item_id = docn['id']
-                status = docn['status']
-            if item_id in output:
-                #skip
-                print("Skipping duplicate")
+        document_proofs.append((loads(revision).get('hash'), result.get('Proof')))
+
+    verified, stats = verify_documents(document_proofs, digest_bytes)
+    print('Verified {} revisions using {} hash operations, {} saved by reusing proof nodes'.format(
+        len(document_proofs), stats['hash_operations'], stats['hash_operations_saved']))
+    return list(zip(document_ids, verified))
+
+def get_block(ledger_name, block_address, digest_tip_address):
+    """
+    Get the block of a ledger's journal. Also returns a proof of the block for verification.
+
+    :type ledger_name: str
+    :param ledger_name: Name of the ledger to operate on.
+
+    :type block_address: dict
+    :param block_address: The location of the block to request.
+
+    :type digest_tip_address: dict
+    :param digest_tip_address: The latest block location covered by the digest.
+
+    :rtype: dict
+    :return: The response of the request.
+    """
+    result = qldb_client.get_block(Name=ledger_name, BlockAddress=block_address, DigestTipAddress=digest_tip_address)
+    return result
+
+def verify_revisions_by_block(ledger_name, docs, digest_bytes, digest_tip_address):
+    """
+    Verify history rows by fetching one proof per distinct journal block instead of one per revision.
+    Each block is verified against the digest, and its hash recomputed from its revisions and entries, so that a
+    revision hash listed in the block is as proven as the block itself.
+
+    :type ledger_name: str
+    :param ledger_name: Name of the ledger containing the documents.
+
+    :type docs: list
+    :param docs: History rows holding the document `id`, `blockAddress` and revision `hash`.
+
+    :type digest_bytes: bytes
+    :param digest_bytes: The ledger digest to verify against.
+
+    :type digest_tip_address: dict
+    :param digest_tip_address: The latest block location covered by the digest.
+
+    :rtype: list
+    :return: A list of (document_id, verified) tuples in row order.
+    """
+    blocks = {}
+    for doc in docs:
+        block_address = doc['blockAddress']
+        blocks.setdefault((block_address['strandId'], block_address['sequenceNo']), block_address)
+
+    block_keys = list(blocks)
+    block_proofs = []
+    block_revisions = []
+    requests = [(ledger_name, block_address_to_dictionary(blocks[key]), digest_tip_address) for key in block_keys]
+    for result in fetch_all(get_block, requests, proof_fetch_concurrency, proof_fetch_limiter):
+        block_hash, revision_hashes = parse_block_contents(result.get('Block'))
+        block_proofs.append((block_hash, result.get('Proof')))
+        block_revisions.append(revision_hashes)
+
+    verified, stats = verify_documents(block_proofs, digest_bytes)
+    print('Verified {} blocks covering {} revisions using {} hash operations, {} saved by reusing proof nodes'.format(
+        len(block_proofs), len(docs), stats['hash_operations'], stats['hash_operations_saved']))
+    trusted_revisions = dict((key, revisions) for key, revisions, block_verified
+                             in zip(block_keys, block_revisions, verified) if block_verified)
+
+    results = []
+    for doc in docs:
+        block_address = doc['blockAddress']
+        revisions = trusted_revisions.get((block_address['strandId'], block_address['sequenceNo']), ())
+        results.append((doc['id'], bytes(doc['hash']) in revisions))
+    return results
+
+def get_latest_items(executor, statement, *parameters):
+    """
+    Run a committed view query once and index its rows by document ID.
+
+    :type executor: :py:class:`pyqldb.execution.executor.Executor`
+    :param executor: An Executor object allowing for execution of statements within a transaction.
+
+    :type statement: str
+    :param statement: The committed view query, selecting `r.metadata.id` as `docid`.
+
+    :type parameters: object
+    :param parameters: Values for the statement placeholders.
+
+    :rtype: dict
+    :return: The latest row of each document, keyed by document ID.
+    """
+    return dict((row['docid'], row) for row in executor.execute_statement(statement, *parameters))
+
+class VerificationReport:
+    """
+    Collects the verification outcome of every item, per batch, and serializes it once at the end of the request.
+    Items are kept in a dict keyed by item ID so duplicate revisions of the same item are collapsed in constant time.
+
+    The state of a checkpointed job only holds the totals of each batch. Each invocation returns the items it
+    verified, and saves them as records of the job so that later invocations do not count them again.
+    """
+
+    def __init__(self, activity, batches=None):
+        self.activity = activity
+        self._batches = batches if batches is not None else {}
+        # Items verified by this invocation, per batch
+        self._items = {}
+
+    @classmethod
+    def from_state(cls, state):
+        return cls(state['activity'], state['batches'])
+
+    def to_state(self):
+        return {'activity': self.activity, 'batches': self._batches}
+
+    def _batch(self, batch):
+        return self._batches.setdefault(batch, {'verified': False, 'failed': False, 'message': '', 'revisions': 0,
+                                                'itemCount': 0, 'statusCounts': {}})
+
+    def add_revision(self, batch, document_id, verified, latest_item, status_field, label):
+        """
+        Record the verification of one history revision. The first unverified revision fails its batch and the
+        rest of the batch is then ignored.
+        """
+        result = self._batch(batch)
+        if result['failed']:
+            return
+        if not verified:
+            print('Document revision is not verified, data compromised - {}'.format(document_id))
+            print('Aborting rest of the verification chain for batch - {}..'.format(batch))
+            self.fail_batch(batch, 'Document revision is not verified, data compromised - {}'.format(document_id))
+            return
+        print('Success! {} verified for document - {}'.format(label, document_id))
+        result['revisions'] += 1
+
+        if latest_item is None or latest_item['batch'] != batch:
+            print('Document {} is no longer part of batch - {}'.format(document_id, batch))
+            return
+        item_id = str(latest_item['id'])
+        items = self._items.setdefault(batch, {})
+        if item_id in items:
+            print("Skipping duplicate")
+            return
+        items[item_id] = str(latest_item[status_field])
+
+    def count_items(self, store=None, job=None, start_position=0):
+        """
+        Add the items verified by this invocation to the totals of their batch, once the invocation is done.
+
+        With a job store, every item is saved as a record of the job along with the position the job reached. An
+        item recorded at or before the position this invocation started from was counted by an earlier invocation
+        and is left out, while one recorded by an invocation which failed before saving the job is counted again.
+
+        :type store: :py:class:`checkpoint.FileCheckpointStore`/:py:class:`checkpoint.DynamoDBCheckpointStore`
+        :param store: The store of the job, None when the request is not a job.
+
+        :type job: dict
+        :param job: The job state.
+
+        :type start_position: int
+        :param start_position: The job position this invocation started from.
+        """
+        for batch, items in self._items.items():
+            result = self._batch(batch)
+            new_items = items
+            if store is not None:
+                keys = dict(('{}/{}'.format(batch, item_id), item_id) for item_id in items)
+                recorded = store.get_records(job['JobId'], list(keys))
+                new_items = dict((item_id, items[item_id]) for key, item_id in keys.items()
+                                 if key not in recorded or json.loads(recorded[key])['Position'] > start_position)
+                store.put_records(job['JobId'], dict(('{}/{}'.format(batch, item_id),
+                                                      json.dumps({'Status': status, 'Position': job['Position']}))
+                                                     for item_id, status in new_items.items()), job.get('ExpiresAt'))
+            result['itemCount'] += len(new_items)
+            for status in new_items.values():
+                result['statusCounts'][status] = result['statusCounts'].get(status, 0) + 1
+
+    def fail_batch(self, batch, message):
+        result = self._batch(batch)
+        if not result['failed']:
+            result['failed'] = True
+            result['message'] = message
+
+    def complete(self, batches, label):
+        for batch in batches:
+            result = self._batch(batch)
+            if result['failed']:
+                continue
+            result['verified'] = result['revisions'] > 0
+            if result['verified']:
+                result['message'] = '{} data verified on all items'.format(label)
             else:
-                output = output + item_id + " colchain - " + status + ';'
-        except Exception as e:
-            print('Error in verifying coldchain on document using QLDB returned proof nodes - {}',format(e))
-            status = False
-            
-    return status, output
-
-def verify_batch_compliance(driver, ledger_name, batch):
-    print('Starting batch compliance verification..')
-    status = False 
-    output = ""
-    # Get the current tip of journal in the ledger
-    current_tip = get_digest_result(ledger_name)
-    digest_bytes = current_tip.get('Digest')
-    
-    digestblock_address = current_tip.get('DigestTipAddress')
- 
-    print('Fetching all item revisions with QA under batch - {}, and verifying complaince on each one by one ..'.format(batch))
-    
-    statement = "SELECT r.metadata.id As id, r.blockAddress AS blockAddress FROM history(Item) AS r WHERE r.data.ItemSpecifications.MfgBatchNumber = '{}' AND r.data.ItemSpecifications.QualityCompliance = 'PASS'".format(batch)
+                result['message'] = '{} data not verified on all items'.format(label)
+
+    def to_dict(self):
+        batches = []
+        for batch, result in self._batches.items():
+            batches.append({
+                "Batch": batch,
+                "Verified": result['verified'],
+                "Message": result['message'],
+                "ItemCount": result['itemCount'],
+                "StatusCounts": result['statusCounts'],
+                "Items": self._items.get(batch, {})
+            })
+        return {
+            "Verify": self.activity,
+            "VerifiedBatches": sum(1 for result in self._batches.values() if result['verified']),
+            "Batches": batches
+        }
+
+def query_coldchain_history(driver, package, batches):
+    """
+    Fetch the revisions of all batches when coldchain was activated, along with the latest coldchain status of
+    every item, in a single transaction.
+
+    :type driver: :py:class:`pyqldb.driver.qldb_driver.QldbDriver`
+    :param driver: An instance of the QldbDriver class.
+
+    :type package: str
+    :param package: The package label.
+
+    :type batches: list
+    :param batches: The batch numbers to verify.
+
+    :rtype: tuple
+    :return: The history rows and the latest rows keyed by document ID.
+    """
+    placeholders = ', '.join('?' * len(batches))
+    statement = "SELECT r.metadata.id As id, r.blockAddress AS blockAddress, r.hash AS hash, r.data.ItemSpecifications.MfgBatchNumber AS batch FROM history(Item) AS r WHERE r.data.PackageLabel = ? AND r.data.ItemSpecifications.MfgBatchNumber IN ({}) AND r.data.PackageChain.Status = 'Activated'".format(placeholders)
     print(statement)
-    cursor = driver.execute_lambda(lambda executor: executor.execute_statement(statement))
-    
-    for doc in cursor:
-        document_block_address = doc['blockAddress']
-        document_id = doc['id']
-        
-        result = get_revision(ledger_name, document_id, block_address_to_dictionary(document_block_address), digestblock_address)
-        
-        revision = result.get('Revision').get('IonText')
-            
-        document_hash = loads(revision).get('hash')
-           
-        proof = result.get('Proof')
-            
+    statement1 = "SELECT r.metadata.id AS docid, r.data.ItemId As id, r.data.ItemSpecifications.MfgBatchNumber AS batch, r.data.PackageChain.Status As status FROM _ql_committed_Item AS r WHERE r.data.PackageLabel = ? AND r.data.ItemSpecifications.MfgBatchNumber IN ({})".format(placeholders)
+    print(statement1)
+    return statement_tracer.execute_lambda(driver, lambda executor: (
+        list(executor.execute_statement(statement, package, *batches)),
+        get_latest_items(executor, statement1, package, *batches)))
+
+def query_compliance_history(driver, batches):
+    """
+    Fetch the revisions of all batches with QA passed, along with the latest QA status of every item, in a single
+    transaction.
+
+    :type driver: :py:class:`pyqldb.driver.qldb_driver.QldbDriver`
+    :param driver: An instance of the QldbDriver class.
+
+    :type batches: list
+    :param batches: The batch numbers to verify.
+
+    :rtype: tuple
+    :return: The history rows and the latest rows keyed by document ID.
+    """
+    placeholders = ', '.join('?' * len(batches))
+    statement = "SELECT r.metadata.id As id, r.blockAddress AS blockAddress, r.hash AS hash, r.data.ItemSpecifications.MfgBatchNumber AS batch FROM history(Item) AS r WHERE r.data.ItemSpecifications.MfgBatchNumber IN ({}) AND r.data.ItemSpecifications.QualityCompliance = 'PASS'".format(placeholders)
+    print(statement)
+    statement1 = "SELECT r.metadata.id AS docid, r.data.ItemId As id, r.data.ItemSpecifications.MfgBatchNumber AS batch, r.data.ItemSpecifications.QualityCompliance As qa FROM _ql_committed_Item AS r WHERE r.data.ItemSpecifications.MfgBatchNumber IN ({})".format(placeholders)
+    print(statement1)
+    return statement_tracer.execute_lambda(driver, lambda executor: (
+        list(executor.execute_statement(statement, *batches)), get_latest_items(executor, statement1, *batches)))
+
+# Status field of the latest item rows and label used in messages, per verify activity
+ACTIVITIES = {
+    'Compliance': ('qa', 'Quality compliance'),
+    'Coldchain': ('status', 'Coldchain')
+}
+
+def pending_revisions(docs, digest_tip_address):
+    """
+    Order the history rows covered by the digest deterministically. History rows are immutable, so the same
+    query against the same digest always yields the same list and a position in it can be checkpointed.
+
+    :type docs: list
+    :param docs: History rows holding `id` and `blockAddress`.
+
+    :type digest_tip_address: dict
+    :param digest_tip_address: The latest block location covered by the digest.
+
+    :rtype: list
+    :return: The rows committed at or before the digest tip, in journal order.
+    """
+    tip = loads(digest_tip_address.get('IonText'))
+    covered = []
+    for doc in docs:
+        block_address = doc['blockAddress']
+        if block_address['strandId'] == tip['strandId'] and block_address['sequenceNo'] > tip['sequenceNo']:
+            print('Skipping revision of document {} committed after the digest tip'.format(doc['id']))
+            continue
+        covered.append(doc)
+    covered.sort(key=lambda doc: (str(doc['blockAddress']['strandId']), doc['blockAddress']['sequenceNo'], str(doc['id'])))
+    return covered
+
+def save_job_revisions(store, job, docs, latest_items, status_field):
+    """
+    Save the ordered revisions of a job with the latest state of their item, one record per slice, so that
+    continuations read the slices they verify instead of querying the history again.
+
+    :type store: :py:class:`checkpoint.FileCheckpointStore`/:py:class:`checkpoint.DynamoDBCheckpointStore`
+    :param store: The store of the job.
+
+    :type job: dict
+    :param job: The job state.
+
+    :type docs: list
+    :param docs: The history rows to verify, see `pending_revisions`.
+
+    :type latest_items: dict
+    :param latest_items: The latest rows keyed by document ID.
+
+    :type status_field: str
+    :param status_field: The status field of the latest rows.
+    """
+    def to_record(doc):
+        latest_item = latest_items.get(doc['id'])
+        if latest_item is not None:
+            latest_item = dict((field, None if latest_item.get(field) is None else str(latest_item.get(field)))
+                               for field in ('id', 'batch', status_field))
+        return {'id': str(doc['id']), 'blockAddress': {'strandId': str(doc['blockAddress']['strandId']),
+                                                       'sequenceNo': int(doc['blockAddress']['sequenceNo'])},
+                'hash': to_base_64(bytes(doc['hash'])), 'batch': str(doc['batch']), 'latest': latest_item}
+
+    slice_size = job['SliceSize']
+    store.put_records(job['JobId'], dict(('slice/{}'.format(start // slice_size),
+                                          json.dumps([to_record(doc) for doc in docs[start:start + slice_size]]))
+                                         for start in range(0, len(docs), slice_size)), job.get('ExpiresAt'))
+
+def load_job_revisions(store, job, position):
+    """
+    Read back the slice of revisions of a job starting at a position, see `save_job_revisions`.
+
+    :rtype: tuple
+    :return: The history rows of the slice and the latest rows of their items keyed by document ID.
+    """
+    key = 'slice/{}'.format(position // job['SliceSize'])
+    record = store.get_records(job['JobId'], [key]).get(key)
+    if record is None:
+        raise ValueError('No saved revisions for verification job {} at revision {}'.format(job['JobId'], position))
+    rows = json.loads(record)
+    docs = [dict(row, hash=b64decode(row['hash'])) for row in rows]
+    return docs, dict((row['id'], row['latest']) for row in rows if row['latest'] is not None)
+
+def verify_job(driver, job, report, context=None, store=None):
+    """
+    Verify the revisions of a job from its saved position against the job's digest, one slice at a time.
+    When a Lambda context is passed, processing stops at a slice boundary once the remaining time drops below
+    the configured margin, leaving the job's position at the first revision not yet verified.
+
+    :type driver: :py:class:`pyqldb.driver.qldb_driver.QldbDriver`
+    :param driver: An instance of the QldbDriver class.
+
+    :type job: dict
+    :param job: The job state, updated in place.
+
+    :type report: :py:class:`VerificationReport`
+    :param report: The report to record into.
+
+    :type context: :py:class:`LambdaContext`
+    :param context: The Lambda context used to time-box the job, or None to process every revision.
+
+    :type store: :py:class:`checkpoint.FileCheckpointStore`/:py:class:`checkpoint.DynamoDBCheckpointStore`
+    :param store: The store of a checkpointed job, its revisions are queried once and saved there when it starts.
+
+    :rtype: bool
+    :return: True once every revision of the job has been processed.
+    """
+    status_field, label = ACTIVITIES[job['Verify']]
+    batches = job['Batches']
+    docs = None
+
+    if 'Digest' not in job:
+        if job['Verify'] == 'Coldchain':
+            docs, latest_items = query_coldchain_history(driver, job['Package'], batches)
+        else:
+            docs, latest_items = query_compliance_history(driver, batches)
+        # One digest for the whole job, recent enough to cover every revision returned by the history query
+        min_sequence_no = max([block_address_key(doc['blockAddress'])[1] for doc in docs], default=None)
+        current_tip = digest_provider.get_digest(min_sequence_no)
+        job['Digest'] = to_base_64(current_tip.get('Digest'))
+        job['DigestTipAddress'] = current_tip.get('DigestTipAddress')
+        if not digest_checkpoint.extend(current_tip):
+            for batch in batches:
+                report.fail_batch(batch, 'Ledger digest does not extend the trusted digest checkpoint')
+            report.complete(batches, label)
+            return True
+        job['DigestCheckpointed'] = digest_checkpoint.covers_digest
+        docs = pending_revisions(docs, job['DigestTipAddress'])
+        job['Total'] = len(docs)
+        if store is not None:
+            save_job_revisions(store, job, docs, latest_items, status_field)
+    else:
+        # Proven when the job started, possibly in another container
+        digest_checkpoint.covers_digest = job.get('DigestCheckpointed', False)
+    digest_bytes = b64decode(job['Digest'])
+    digestblock_address = job['DigestTipAddress']
+
+    while job['Position'] < job['Total']:
+        if context is not None and context.get_remaining_time_in_millis() < verification_job_time_margin_ms:
+            print('Time budget reached with {} of {} revisions verified, saving checkpoint'.format(job['Position'], job['Total']))
+            return False
+        if docs is None:
+            chunk, latest_items = load_job_revisions(store, job, job['Position'])
+        else:
+            chunk = docs[job['Position']:job['Position'] + job['SliceSize']]
+        # Revisions verified by an earlier audit need no new proof
+        trusted = digest_checkpoint.get_trusted([(doc['id'], doc['blockAddress'], doc['hash']) for doc in chunk])
+        untrusted = [doc for doc, is_trusted in zip(chunk, trusted) if not is_trusted]
+        print('{} of {} revisions already verified against the trusted digest checkpoint'.format(len(chunk) - len(untrusted), len(chunk)))
         try:
-            verified = verify_document(document_hash, digest_bytes, proof)
-            if not verified:
-                print('Document revision is not verified, data compromised - {}'.format(document_id))
-                print('Aborting rest of the verification chain..')
-                status = False
-                return status
-            else:
-                print('Success! Compliance verified for document - {}'. format(document_id))
-                status = True
-            # Fetch latest revision for QA status to report 
-            statement1 = "SELECT r.data.ItemId As id, r.data.ItemSpecifications.QualityCompliance As qa FROM _ql_committed_Item AS r WHERE r.data.ItemSpecifications.MfgBatchNumber = '{}' AND r.metadata.id = '{}'".format(batch, document_id)
-            print(statement1)
-            cursor1 = driver.execute_lambda(lambda executor: executor.execute_statement(statement1))
-            for docn in cursor1:
-                item_id = docn['id']
-                status = docn['qa']
-            if item_id in output:
-                #skip
-                print("Skipping duplicate")
+            if job['Mode'] == BLOCK_MODE:
+                verified_revisions = verify_revisions_by_block(ledger_name, untrusted, digest_bytes, digestblock_address)
             else:
-                output = output + item_id + " Quality Compliance - " + status + ';'            
+                verified_revisions = verify_revisions(ledger_name, untrusted, digest_bytes, digestblock_address)
         except Exception as e:
-            print('Error in verifying compliance document chain using QLDB returned proof nodes - {}',format(e))
-            status = False
-            
-    return status, output
+            print('Error in verifying {} using QLDB returned proof nodes - {}'.format(label, e))
+            if context is not None:
+                # Keep the checkpoint at this slice so the job can be resumed
+                job['LastError'] = str(e)
+                return False
+            for batch in batches:
+                report.fail_batch(batch, 'Error in verifying {} using QLDB returned proof nodes - {}'.format(label, e))
+            break
+        verified_revisions = iter(verified_revisions)
+        for doc, is_trusted in zip(chunk, trusted):
+            if is_trusted:
+                document_id, verified = doc['id'], True
+            else:
+                document_id, verified = next(verified_revisions)
+                if verified:
+                    digest_checkpoint.add(document_id, doc['blockAddress'], doc['hash'])
+            report.add_revision(doc['batch'], document_id, verified, latest_items.get(document_id), status_field, label)
+        job['Position'] += len(chunk)
+        digest_checkpoint.save()
+
+    report.complete(batches, label)
+    return True
     
 
+
+@statement_tracer.traced
 def lambda_handler(event, context):
     
     # Read the event paylaod for ledgername , batchnumber, package , activity
     
-    API_flow = False
     processing_error = False
     return_message = ''
-    verify_status = False
+    status_code = 200
     
     if event.get('body') is None:
         # pick from lambda test console payload
         print("AWS Lambda console flow")
-        verify_activity = event.get('verify')
+        payload = event
     else:
-        API_flow = True
         # pick from API request
-        body_dict_payload = json.loads(event.get('body'))
-        verify_activity = body_dict_payload.get('verify')
+        payload = json.loads(event.get('body'))
     
     try:
-        with create_qldb_driver(ledger_name) as driver:
-            
-            if verify_activity == 'Compliance':
-                if API_flow:
-                    batches = body_dict_payload.get('data').get('batch')
-                else:
-                    batches = event.get('data').get('batch')
-                
-                for eachbatch in batches:
-    
-                    print("Verifying ledger for Quality compliance on batch - {}. Processing ...".format(eachbatch))
-                            
-                    verify_status, msg = verify_batch_compliance(driver, ledger_name, eachbatch)
-                        
-                    if verify_status:
-                        return_message = ''+ eachbatch + ': Quality compliance data verified on all items ->' + msg
-                    else:
-                        return_message = ''+ eachbatch + ': Quality compliance data not verified on all items ->' + msg
-            
-            if verify_activity == 'Coldchain':
-                
-                if API_flow:
-                    package = body_dict_payload.get('package')
-                    batches = body_dict_payload.get('data').get('batch')
-                else:
-                    package = event.get('package')
-                    batches = event.get('data').get('batch') 
-                    
-                for eachbatch in batches:
-    
-                    print("Verifying ledger for coldchain on package - {} and batch - {}. Processing ...".format(package, eachbatch))
-                            
-                    verify_status, msg = verify_coldchain(driver, ledger_name, package, eachbatch)
-                        
-                    if verify_status:
-                        return_message = ''+ eachbatch + ': Coldchain data verified on all items -> ' + msg
-                    else:
-                        return_message = ''+ eachbatch + ': Coldchain data not verified on all items -> ' + msg
-            
+        store = None
+        continuation_token = payload.get('continuationToken')
+        if continuation_token:
+            # Resume a checkpointed job, everything else comes from the saved state
+            store = create_checkpoint_store()
+            job = store.load(continuation_token)
+            if job is None:
+                raise ValueError('No verification job found for continuation token - {}'.format(continuation_token))
+            print('Resuming verification job {} at revision {} of {}'.format(continuation_token, job['Position'], job['Total']))
+            report = VerificationReport.from_state(job['Report'])
+        else:
+            # Every batch is verified in the same pass, so duplicates in the request are dropped
+            batches = list(dict.fromkeys(payload.get('data').get('batch')))
+            if not batches:
+                raise ValueError('No batch passed for verification')
+            if payload.get('verify') not in ACTIVITIES:
+                raise ValueError('Unsupported verify activity - {}'.format(payload.get('verify')))
+            job = {
+                'JobId': str(uuid.uuid4()),
+                'Verify': payload.get('verify'),
+                'Mode': payload.get('mode', REVISION_MODE),
+                'Package': payload.get('package'),
+                'Batches': batches,
+                'Position': 0,
+                'Total': 0,
+                'SliceSize': verification_job_slice_size,
+                # Records of the job are left to expire, see `checkpoint.DynamoDBCheckpointStore`
+                'ExpiresAt': int(time()) + verification_job_ttl_sec
+            }
+            report = VerificationReport(job['Verify'])
+            if payload.get('job'):
+                store = create_checkpoint_store()
+
+        start_position = job['Position']
+        with pooled_qldb_driver(ledger_name) as driver:
+            print("Verifying ledger for {} on batches - {}. Processing ...".format(job['Verify'], job['Batches']))
+            complete = verify_job(driver, job, report, context if store is not None else None, store)
+
+        report.count_items(store, job, start_position)
+        body = report.to_dict()
+        if store is not None:
+            job['Report'] = report.to_state()
+            if complete:
+                store.delete(job['JobId'])
+            else:
+                store.save(job['JobId'], job)
+                status_code = 202
+                body['ContinuationToken'] = job['JobId']
+            body.update({'JobId': job['JobId'], 'Complete': complete, 'Position': job['Position'], 'Total': job['Total']})
+        return_message = json.dumps(body)
     except Exception as e:
             processing_error = True
-            print('Server processing failed during verification due to unexpected error - {}',format(e))
-            return_message = 'Server processing failed during verification due to unexpected error - {}',format(e)
+            print('Server processing failed during verification due to unexpected error - {}'.format(e))
+            return_message = 'Server processing failed during verification due to unexpected error - {}'.format(e)
                 
     
     if not processing_error:
             
         return {
             "isBase64Encoded": False,
-            "statusCode": 200,
+            "statusCode": status_code,
             "body": return_message
         }
     else:
@@ -18,53 +18,147 @@
 
 # To create & seed dummy data on the ledger table - Item
 
-from time import sleep
-from datetime import datetime
-from decimal import Decimal
-from boto3 import client
-from common import convert_object_to_ion, create_qldb_driver, to_base_64
-from pyqldb.driver.qldb_driver import QldbDriver
+from concurrent.futures import ThreadPoolExecutor
+from time import monotonic
+from common import convert_object_to_ion, pooled_qldb_driver, prewarm_qldb_driver, get_document_ids_from_dml_results, \
+    DecorrelatedJitterBackoff, IonDocumentTemplate, StatementTracer
+from constants import Constants
 import json
 import os
 
-qldb_client = client('qldb')
 ledger_name = os.environ.get('LedgerNameString')
+statement_tracer = StatementTracer.from_environment('itemCreator')
+# QLDB allows up to 40 documents to be modified in a single transaction
+insert_chunk_size = int(os.environ.get('InsertChunkSize', Constants.INSERT_CHUNK_SIZE))
+existence_check_chunk_size = int(os.environ.get('ExistenceCheckChunkSize', Constants.EXISTENCE_CHECK_CHUNK_SIZE))
+# Chunk writers share one driver, each holding at most one session of its pool
+insert_concurrency = int(os.environ.get('InsertConcurrency', Constants.INSERT_CONCURRENCY))
+prewarm_qldb_driver(ledger_name, insert_concurrency)
 
-def insert_item_document(driver, table_name, document, fieldname , fieldvalue):   
-    print('First Checking if record exist or not') 
-    statement = "SELECT * FROM {} WHERE {} = '{}'".format(table_name,fieldname, fieldvalue)
-    print(statement)
-    cursor = driver.execute_lambda(lambda executor: executor.execute_statement(statement))
-    # Check if there is any record in the cursor
-    first_record = next(cursor, None)
-    
-    if first_record:
-        # Record already exists, no need to insert
-        print("Existing record, fetching document ID from commited metadata")
-        statement = "SELECT metadata.id, metadata.version FROM _ql_committed_{} AS p WHERE p.data.{} = '{}'".format(table_name,fieldname, fieldvalue)
-        print(statement)
-        cursor = driver.execute_lambda(lambda executor: executor.execute_statement(statement))
-        for doc in cursor:
-            document_id = doc['id']   
-        pass
-    else:
-        print("Record does not exist")
-        print('Inserting documents in the {} table...'.format(table_name))
-        statement = 'INSERT INTO {} ?'.format(table_name)
-        cursor = driver.execute_lambda(lambda executor: executor.execute_statement(statement,convert_object_to_ion(document)))
-        
-        if next(cursor, None):
-            statement = "SELECT metadata.id, metadata.version FROM _ql_committed_{} AS p WHERE p.data.{} = '{}'".format(table_name,fieldname, fieldvalue)
-            newcursor = driver.execute_lambda(lambda executor: executor.execute_statement(statement))
-            for doc in newcursor:
-                document_id = doc['id']
-    # return document_id
-    return document_id
+def get_existing_values(driver, table_name, fieldname, values, chunk_size=existence_check_chunk_size):
+    """
+    Find which of the given field values already exist, with one indexed projection query per chunk.
+
+    :type driver: :py:class:`pyqldb.driver.qldb_driver.QldbDriver`
+    :param driver: An instance of the QldbDriver class.
+
+    :type table_name: str
+    :param table_name: The table to query.
+
+    :type fieldname: str
+    :param fieldname: The indexed field to look up.
+
+    :type values: list
+    :param values: The candidate field values.
+
+    :type chunk_size: int
+    :param chunk_size: The number of values per IN list.
+
+    :rtype: set
+    :return: The field values which already exist.
+    """
+    def query_existing(executor):
+        existing = set()
+        for start in range(0, len(values), chunk_size):
+            chunk = values[start:start + chunk_size]
+            statement = 'SELECT {0} FROM {1} WHERE {0} IN ({2})'.format(fieldname, table_name, ', '.join('?' * len(chunk)))
+            existing.update(row[fieldname] for row in executor.execute_statement(statement, *chunk))
+        return existing
+
+    print('Checking which of {} {} values already exist in the {} table'.format(len(values), fieldname, table_name))
+    return statement_tracer.execute_lambda(driver, query_existing)
+
+def insert_item_chunk(executor, table_name, documents, fieldname):
+    """
+    Insert the documents of one chunk in a single statement, skipping those whose field value already exists.
+
+    :type executor: :py:class:`pyqldb.execution.executor.Executor`
+    :param executor: An Executor object allowing for execution of statements within a transaction.
+
+    :type table_name: str
+    :param table_name: The table to insert into.
+
+    :type documents: list
+    :param documents: The documents of the chunk.
+
+    :type fieldname: str
+    :param fieldname: The unique field identifying a document.
+
+    :rtype: dict
+    :return: The inserted document IDs keyed by field value.
+    """
+    # The existence check ran in an earlier transaction, a concurrent request may have inserted the same values since.
+    # Reading them again here makes the transaction conflict with such an insert and retry.
+    values = [document[fieldname] for document in documents]
+    statement = 'SELECT {0} FROM {1} WHERE {0} IN ({2})'.format(fieldname, table_name, ', '.join('?' * len(values)))
+    existing = set(row[fieldname] for row in executor.execute_statement(statement, *values))
+    documents = [document for document in documents if document[fieldname] not in existing]
+    if not documents:
+        return {}
+    statement = 'INSERT INTO {} << {} >>'.format(table_name, ', '.join('?' * len(documents)))
+    cursor = executor.execute_statement(statement, *[convert_object_to_ion(document) for document in documents])
+    # DML results are returned in the order of the inserted values
+    document_ids = get_document_ids_from_dml_results(cursor)
+    return {document[fieldname]: document_id for document, document_id in zip(documents, document_ids)}
+
+def insert_item_documents(driver, table_name, documents, fieldname, chunk_size=insert_chunk_size,
+                          max_workers=insert_concurrency):
+    """
+    Insert the documents in chunks, one transaction per chunk, spread over a bounded pool of writers.
+
+    :type driver: :py:class:`pyqldb.driver.qldb_driver.QldbDriver`
+    :param driver: An instance of the QldbDriver class, shared by all writers.
+
+    :type table_name: str
+    :param table_name: The table to insert into.
+
+    :type documents: list
+    :param documents: The documents to insert.
+
+    :type fieldname: str
+    :param fieldname: The unique field identifying a document.
+
+    :type chunk_size: int
+    :param chunk_size: The number of documents per transaction.
+
+    :type max_workers: int
+    :param max_workers: The number of chunks written concurrently.
+
+    :rtype: tuple
+    :return: The inserted document IDs keyed by field value and the per-chunk results.
+    """
+    def write_chunk(number, chunk):
+        print('Inserting chunk {} of {} documents in the {} table...'.format(number, len(chunk), table_name))
+        # Retries on OCC conflicts are spread out with decorrelated jitter and counted per chunk
+        backoff = DecorrelatedJitterBackoff()
+        started = monotonic()
+        result = statement_tracer.execute_lambda(
+            driver, lambda executor: insert_item_chunk(executor, table_name, chunk, fieldname), backoff.retry_config())
+        elapsed_ms = int((monotonic() - started) * 1000)
+        print('Chunk {} done in {} ms after {} retries'.format(number, elapsed_ms, backoff.retries))
+        return result, {'Chunk': number, 'Inserted': len(result), 'ElapsedMs': elapsed_ms, 'Retries': backoff.retries,
+                        'OccConflicts': backoff.occ_conflicts}
+
+    chunks = [documents[start:start + chunk_size] for start in range(0, len(documents), chunk_size)]
+    document_ids = {}
+    chunk_results = []
+    if not chunks:
+        return document_ids, chunk_results
+    with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(chunks)))) as pool:
+        for result, chunk_result in pool.map(lambda args: write_chunk(*args), enumerate(chunks, 1)):
+            document_ids.update(result)
+            chunk_results.append(chunk_result)
+    return document_ids, chunk_results
   
+@statement_tracer.traced
 def lambda_handler(event, context):
     API_flow = False
     processingerror = False
     return_msg = ''
+    existing_ids = set()
+    document_ids = {}
+    chunks = []
+    elapsed_ms = 0
     
     if event.get('body') is None:
         print("lambda console flow")
@@ -80,7 +174,7 @@ def lambda_handler(event, context):
         
     # Create QLDB driver for item processing
     try:
-        with create_qldb_driver(ledger_name) as driver:
+        with pooled_qldb_driver(ledger_name, insert_concurrency) as driver:
             # Fetch the authenticated user email, if invoked via auth flow else use default 
             useremail = ''
             if event.get('requestContext').get('authorizer') is not None:
@@ -88,20 +182,23 @@ def lambda_handler(event, context):
                     useremail = event.get('requestContext').get('authorizer').get('claims').get('email')
                     print('Authorized user email on token - {}'.format(useremail))
                 
-            for i in range(1,unit_count+1):
-                item_id = batch_number+"000"+str(i)
-                newitem = {'ItemId':item_id, "PkgOwner": useremail}
-                if API_flow:
-                    itempayload = body_dict_payload.get('item')
-                else:
-                    itempayload = event.get('item')
-                itempayload.update(newitem)
-                print('Preparing to insert document - {}'.format(i))
-                doc_id = insert_item_document(driver,"Item", itempayload, 'ItemId' , item_id)
+            if API_flow:
+                itempayload = body_dict_payload.get('item')
+            else:
+                itempayload = event.get('item')
+            item_ids = [batch_number+"000"+str(i) for i in range(1,unit_count+1)]
+            existing_ids = get_existing_values(driver, "Item", 'ItemId', item_ids)
+            # Every unit shares the payload, only the ItemId is converted per document
+            template = IonDocumentTemplate(dict(itempayload, PkgOwner=useremail))
+            documents = [template.render(ItemId=item_id) for item_id in item_ids if item_id not in existing_ids]
+            print('{} units already exist, preparing to insert {} documents in chunks of {}'.format(len(existing_ids), len(documents), insert_chunk_size))
+            started = monotonic()
+            document_ids, chunks = insert_item_documents(driver, "Item", documents, 'ItemId')
+            elapsed_ms = int((monotonic() - started) * 1000)
                 
     except Exception as e:
         processingerror = True
-        print('Error inserting or updating documents- {}',format(e))
+        print('Error inserting or updating documents- {}'.format(e))
     if not processingerror:
         return_msg = "Successfully added Items"
     else:
@@ -110,7 +207,8 @@ def lambda_handler(event, context):
     response = {
         "isBase64Encoded": "false",
         "statusCode": 200,
-        "body": return_msg
+        "body": json.dumps({'Message': return_msg, 'Existing': len(existing_ids), 'DocumentIds': document_ids,
+                            'ElapsedMs': elapsed_ms, 'Chunks': chunks})
     }
     
     return response
\ No newline at end of file
@@ -18,35 +18,28 @@
 
 # Functionality to support retrieval for specific Item record
 
-from time import sleep
-from datetime import datetime
-from decimal import Decimal
-from boto3 import client
-from common import convert_object_to_ion, block_address_to_dictionary, value_holder_to_string, create_qldb_driver
+from common import block_address_to_dictionary, pooled_qldb_driver, prewarm_qldb_driver, fetch_all, TokenBucket, \
+    VerificationCache, DigestProvider, block_address_key, get_qldb_client, StatementTracer
+from constants import Constants
 from verifier import verify_document
-from pyqldb.driver.qldb_driver import QldbDriver
-from base64 import encode, decode, b64encode, b64decode
 import json
-from amazon.ion.simpleion import dumps, loads
-import ionhash
+from amazon.ion.simpleion import loads
 import os
 
-qldb_client = client('qldb')
+qldb_client = get_qldb_client()
 ledger_name = os.environ.get('LedgerNameString')
-
-def get_digest_result(name):
-    """
-    Get the digest of a ledger's journal.
-
-    :type name: str
-    :param name: Name of the ledger to operate on.
-
-    :rtype: dict
-    :return: The digest in a 256-bit hash value and a block address.
-    """
-    print("Let's get the current digest of the ledger named {}".format(name))
-    result = qldb_client.get_digest(Name=name)
-    return result
+statement_tracer = StatementTracer.from_environment('itemGet')
+prewarm_qldb_driver(ledger_name)
+proof_fetch_concurrency = int(os.environ.get('ProofFetchConcurrency', Constants.PROOF_FETCH_CONCURRENCY))
+# Shared across warm invocations so the request rate stays adapted to QLDB throttling
+proof_fetch_limiter = TokenBucket(float(os.environ.get('ProofFetchRate', Constants.PROOF_FETCH_RATE_PER_SEC)))
+# Revisions verified by earlier invocations of this container, reused while the ledger tip has not moved too far
+verification_cache = VerificationCache(
+    int(os.environ.get('VerificationCacheSize', Constants.VERIFICATION_CACHE_SIZE)),
+    float(os.environ.get('VerificationCacheTtlSec', Constants.VERIFICATION_CACHE_TTL_SEC)),
+    int(os.environ.get('VerificationCacheMaxStaleness', Constants.VERIFICATION_CACHE_MAX_STALENESS)))
+# One digest per TTL window for the container, shared by the compliance and coldchain verifications
+digest_provider = DigestProvider.from_environment(qldb_client, ledger_name)
 
 def get_revision(ledger_name, document_id, block_address, digest_tip_address):
     """
@@ -71,60 +64,87 @@ def get_revision(ledger_name, document_id, block_address, digest_tip_address):
     result = qldb_client.get_revision(Name=ledger_name, BlockAddress=block_address, DocumentId=document_id,
                                       DigestTipAddress=digest_tip_address)
     return result
+
+def get_revisions(ledger_name, docs, digest_tip_address):
+    """
+    Fetch the revision of each history row concurrently.
+
+    :type ledger_name: str
+    :param ledger_name: Name of the ledger containing the documents.
+
+    :type docs: list
+    :param docs: History rows holding the document `id` and `blockAddress`.
+
+    :type digest_tip_address: dict
+    :param digest_tip_address: The latest block location covered by the digest.
+
+    :rtype: list
+    :return: A list of (document_id, get_revision response) tuples in row order.
+    """
+    docs = list(docs)
+    requests = [(ledger_name, doc['id'], block_address_to_dictionary(doc['blockAddress']), digest_tip_address)
+                for doc in docs]
+    results = fetch_all(get_revision, requests, proof_fetch_concurrency, proof_fetch_limiter)
+    return [(doc['id'], result) for doc, result in zip(docs, results)]
     
 
-def verify_coldchain(driver, ledger_name, package, itemid):
-    print('Starting coldchain verification..')
-    status = False 
-    # Get the current tip of journal in the ledger
-    current_tip = get_digest_result(ledger_name)
-    digest_bytes = current_tip.get('Digest')    
+def verify_revisions(ledger_name, docs, activity):
+    """
+    Verify history rows against a recent digest covering all of them. Revisions verified recently by this
+    container are taken from the verification cache, only the others are fetched with `get_revision` and verified.
+
+    :type ledger_name: str
+    :param ledger_name: Name of the ledger containing the documents.
+
+    :type docs: list
+    :param docs: History rows holding the document `id`, `blockAddress` and revision `hash`.
+
+    :type activity: str
+    :param activity: Name of the verified data, used in messages.
+
+    :rtype: bool
+    :return: The verification result of the last revision, False if there is none.
+    """
+    docs = list(docs)
+    if not docs:
+        return False
+    current_tip = digest_provider.get_digest(max(block_address_key(doc['blockAddress'])[1] for doc in docs))
+    digest_bytes = current_tip.get('Digest')
     digestblock_address = current_tip.get('DigestTipAddress')
-    statement = "SELECT r.metadata.id As id, r.blockAddress AS blockAddress FROM history(Item) AS r WHERE r.data.ItemId = '{}' and r.data.PackageLabel = '{}' AND r.data.PackageChain.Status = 'Activated'".format(itemid, package)
-    cursor = driver.execute_lambda(lambda executor: executor.execute_statement(statement))
-    
-    for doc in cursor:
-        document_block_address = doc['blockAddress']
-        document_id = doc['id']
-        result = get_revision(ledger_name, document_id, block_address_to_dictionary(document_block_address), digestblock_address)
+    tip_sequence_no = block_address_key(digestblock_address)[1]
+
+    verified = [verification_cache.get(doc['id'], doc['blockAddress'], tip_sequence_no) == bytes(doc['hash'])
+                for doc in docs]
+    pending = [index for index, cached in enumerate(verified) if not cached]
+
+    revisions = get_revisions(ledger_name, [docs[index] for index in pending], digestblock_address)
+    for index, (document_id, result) in zip(pending, revisions):
         revision = result.get('Revision').get('IonText')
         document_hash = loads(revision).get('hash')
         proof = result.get('Proof')
-            
+
         try:
-            verified = verify_document(document_hash, digest_bytes, proof)
-            status = verified
+            verified[index] = verify_document(document_hash, digest_bytes, proof)
         except Exception as e:
-            print('Error in verifying coldchain on document using QLDB returned proof nodes - {}',format(e))
-            status = False
-    return status
+            print('Error in verifying {} on document using QLDB returned proof nodes - {}'.format(activity, e))
+            verified[index] = False
+        if verified[index]:
+            verification_cache.put(document_id, docs[index]['blockAddress'], document_hash, tip_sequence_no)
+    return verified[-1]
+
+def verify_coldchain(driver, ledger_name, package, itemid):
+    print('Starting coldchain verification..')
+    statement = "SELECT r.metadata.id As id, r.blockAddress AS blockAddress, r.hash AS hash FROM history(Item) AS r WHERE r.data.ItemId = '{}' and r.data.PackageLabel = '{}' AND r.data.PackageChain.Status = 'Activated'".format(itemid, package)
+    cursor = statement_tracer.execute_lambda(driver, lambda executor: executor.execute_statement(statement))
+    return verify_revisions(ledger_name, cursor, 'coldchain')
 
 def verify_batch_compliance(driver, ledger_name, batch, itemid):
     print('Starting batch compliance verification')
-    status = False
-    # Get the current tip of journal in the ledger
-    current_tip = get_digest_result(ledger_name)
-    digest_bytes = current_tip.get('Digest')
-    digestblock_address = current_tip.get('DigestTipAddress')
-    statement = "SELECT r.metadata.id As id, r.blockAddress AS blockAddress FROM history(Item) AS r BY r_id WHERE r.data.ItemId = '{}' and r.data.ItemSpecifications.MfgBatchNumber = '{}' AND r.data.ItemSpecifications.QualityCompliance = 'PASS'".format(itemid, batch)
-    cursor = driver.execute_lambda(lambda executor: executor.execute_statement(statement))
-    
-    for doc in cursor:
-        document_block_address = doc['blockAddress']
-        document_id = doc['id']
-        result = get_revision(ledger_name, document_id, block_address_to_dictionary(document_block_address), digestblock_address)
-        revision = result.get('Revision').get('IonText')
-        document_hash = loads(revision).get('hash')
-        proof = result.get('Proof')
-            
-        try:
-            verified = verify_document(document_hash, digest_bytes, proof)
-            status = verified
-        except Exception as e:
-            print('Error in verifying compliance document chain using QLDB returned proof nodes - {}',format(e))
-            status = False
-    return status
+    statement = "SELECT r.metadata.id As id, r.blockAddress AS blockAddress, r.hash AS hash FROM history(Item) AS r BY r_id WHERE r.data.ItemId = '{}' and r.data.ItemSpecifications.MfgBatchNumber = '{}' AND r.data.ItemSpecifications.QualityCompliance = 'PASS'".format(itemid, batch)
+    cursor = statement_tracer.execute_lambda(driver, lambda executor: executor.execute_statement(statement))
+    return verify_revisions(ledger_name, cursor, 'compliance')
 
+@statement_tracer.traced
 def lambda_handler(event, context):
     processing_error = False
     return_message = ''
@@ -138,12 +158,12 @@ def lambda_handler(event, context):
     
     if not processing_error:
         try:
-            with create_qldb_driver(ledger_name) as driver:
+            with pooled_qldb_driver(ledger_name) as driver:
                 if type_name == 'item':
                     print("Trying to get details for {} - {}. Processing ...".format(type_name, type_value))
                     statement = "select r.data from _ql_committed_Item As r where r.data.ItemId = '{}'".format(type_value)
                     print(statement)
-                    cursor = driver.execute_lambda(lambda executor: executor.execute_statement(statement))
+                    cursor = statement_tracer.execute_lambda(driver, lambda executor: executor.execute_statement(statement))
                     item_details = {}
                     for doc in cursor:
                         item_id = doc['data']['ItemId']
@@ -162,6 +182,7 @@ def lambda_handler(event, context):
                         coldchain_message = 'Verified'
                     else:
                         coldchain_message = 'Not Verified'
+                    verification_cache.log_stats()
         except Exception as e:
             processing_error = True
             print('Server processing failed during verification due to unexpected error - {}',format(e))
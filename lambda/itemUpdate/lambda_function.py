@@ -18,92 +18,185 @@
 
 # Processing functionality for updating Item records on journal
 
-from time import sleep
-from datetime import datetime
-from decimal import Decimal
-from boto3 import client
-from common import convert_object_to_ion, create_qldb_driver, to_base_64
-from pyqldb.driver.qldb_driver import QldbDriver
+from common import pooled_qldb_driver, prewarm_qldb_driver, get_document_ids_from_dml_results, StatementTracer
+from constants import Constants
 import json
 import os
-import uuid
 
-qldb_client = client('qldb')
 ledger_name = os.environ.get('LedgerNameString')
+statement_tracer = StatementTracer.from_environment('itemUpdate')
+prewarm_qldb_driver(ledger_name)
+# QLDB allows up to 40 documents to be modified in a single transaction
+update_chunk_size = int(os.environ.get('UpdateChunkSize', Constants.UPDATE_CHUNK_SIZE))
 
-def update_item_compliance(driver, table_name, document, fieldname , fieldvalue, data, useremail):
-   
-    print('First Checking if record exist or not') 
-    
-    statement = "SELECT metadata.id FROM _ql_committed_{} As p WHERE p.data.ItemSpecifications.QualityCompliance = '' AND p.data.ItemSpecifications.{} = '{}'".format(table_name,fieldname, fieldvalue)
-    print(statement)
-    cursor = driver.execute_lambda(lambda executor: executor.execute_statement(statement))
+def update_if_exists(executor, check_statement, check_parameters, update_statement, update_parameters):
+    """
+    Run the update only if the check statement finds a record, both in the transaction of the given executor.
+
+    :type executor: :py:class:`pyqldb.execution.executor.Executor`
+    :param executor: An Executor object allowing for execution of statements within a transaction.
+
+    :type check_statement: str
+    :param check_statement: The statement selecting the records which must exist.
+
+    :type check_parameters: list
+    :param check_parameters: The parameters of the check statement.
+
+    :type update_statement: str
+    :param update_statement: The update statement.
+
+    :type update_parameters: list
+    :param update_parameters: The parameters of the update statement.
+
+    :rtype: list
+    :return: The IDs of the updated documents, empty if no record was found.
+    """
     # Check if there is any record in the cursor
-    first_record = next(cursor, None)
-    doccount = 0
-
-    if first_record:
-        print("Existing record found, initiating document update processing..")
-        statement = "UPDATE {} As u SET u.ItemSpecifications.QualityCompliance = '{}', PkgOwner = '{}' WHERE u.ItemSpecifications.MfgBatchNumber = '{}'".format(table_name,data, useremail,fieldvalue)
-        print(statement)
-        cursor = driver.execute_lambda(lambda executor: executor.execute_statement(statement))
-        doccount = 0
-        for doc in cursor:
-            doccount = doccount + 1
-    else:
+    first_record = next(iter(executor.execute_statement(check_statement, *check_parameters)), None)
+    if first_record is None:
+        return []
+    cursor = executor.execute_statement(update_statement, *update_parameters)
+    return get_document_ids_from_dml_results(cursor)
+
+def update_item_compliance(driver, table_name, document, fieldname , fieldvalue, data, useremail):
+    print('Checking if record exist and updating it in one transaction') 
+    check_statement = "SELECT metadata.id FROM _ql_committed_{} As p WHERE p.data.ItemSpecifications.QualityCompliance = '' AND p.data.ItemSpecifications.{} = ?".format(table_name,fieldname)
+    update_statement = "UPDATE {} As u SET u.ItemSpecifications.QualityCompliance = ?, u.PkgOwner = ? WHERE u.ItemSpecifications.MfgBatchNumber = ?".format(table_name)
+    print(check_statement)
+    print(update_statement)
+    document_ids = statement_tracer.execute_lambda(driver, lambda executor: update_if_exists(
+        executor, check_statement, [fieldvalue], update_statement, [data, useremail, fieldvalue]))
+    if not document_ids:
         print("No existing record found for compliance update!")
-    return doccount
+    return document_ids
     
 def update_item_coldchain(driver,table_name, document, fieldname , fieldvalue, data, useremail):
-    print('First Checking if record exist or not') 
-    statement = "SELECT metadata.id FROM _ql_committed_{} As p WHERE p.data.{} = '{}' AND p.data.ItemSpecifications.MfgBatchNumber = '{}'".format(table_name,fieldname, fieldvalue, document.get('batch'))
-    print(statement)
-    cursor = driver.execute_lambda(lambda executor: executor.execute_statement(statement))
-    # Check if there is any record in the cursor
-    first_record = next(cursor, None)
-    doccount = 0
-
-    if first_record:
-        print("Existing record found, initiating document update processing..")
-        statement = "UPDATE {} As u SET u.PackageSeal = '{}', u.PkgOwner = '{}', u.PackageChain.Status = '{}' WHERE u.PackageLabel = '{}' AND u.ItemSpecifications.MfgBatchNumber = '{}'".format(table_name,data, useremail,"Activated",fieldvalue, document.get('batch'))
-        print(statement)
-        cursor = driver.execute_lambda(lambda executor: executor.execute_statement(statement))
-        doccount = 0
-        for doc in cursor:
-            doccount = doccount + 1
-        print(doccount)
-    else:
+    print('Checking if record exist and updating it in one transaction') 
+    check_statement = "SELECT metadata.id FROM _ql_committed_{} As p WHERE p.data.{} = ? AND p.data.ItemSpecifications.MfgBatchNumber = ?".format(table_name,fieldname)
+    update_statement = "UPDATE {} As u SET u.PackageSeal = ?, u.PkgOwner = ?, u.PackageChain.Status = ? WHERE u.PackageLabel = ? AND u.ItemSpecifications.MfgBatchNumber = ?".format(table_name)
+    print(check_statement)
+    print(update_statement)
+    document_ids = statement_tracer.execute_lambda(driver, lambda executor: update_if_exists(
+        executor, check_statement, [fieldvalue, document.get('batch')],
+        update_statement, [data, useremail, "Activated", fieldvalue, document.get('batch')]))
+    if not document_ids:
         print("No existing record found for update!")
-    # return doccount
-    return doccount
+    return document_ids
 
 def update_item_packaging(driver, table_name, document, fieldname , fieldvalue, useremail):
-    print('First Checking if record exist or not') 
-    statement = "SELECT metadata.id FROM _ql_committed_{} As p WHERE p.data.{} = '{}'".format(table_name,fieldname, fieldvalue)
-    print(statement)
-    cursor = driver.execute_lambda(lambda executor: executor.execute_statement(statement))
-    # Check if there is any record in the cursor
-    first_record = next(cursor, None)
-    doccount = 0
-
-    if first_record:
-        print("Existing record found, initiating document update processing..")
-        statement = "UPDATE {} As u SET u.PackageLabel = '{}', u.PkgOwner = '{}' WHERE u.ItemId = '{}' AND u.ItemSpecifications.MfgBatchNumber = '{}'".format(table_name,document.get('package'),useremail ,fieldvalue, document.get('batch'))
-        print(statement)
-        cursor = driver.execute_lambda(lambda executor: executor.execute_statement(statement))
-        doccount = 0
-        for doc in cursor:
-            doccount = doccount + 1
-    else:
+    print('Checking if record exist and updating it in one transaction') 
+    check_statement = "SELECT metadata.id FROM _ql_committed_{} As p WHERE p.data.{} = ?".format(table_name,fieldname)
+    update_statement = "UPDATE {} As u SET u.PackageLabel = ?, u.PkgOwner = ? WHERE u.ItemId = ? AND u.ItemSpecifications.MfgBatchNumber = ?".format(table_name)
+    print(check_statement)
+    print(update_statement)
+    document_ids = statement_tracer.execute_lambda(driver, lambda executor: update_if_exists(
+        executor, check_statement, [fieldvalue],
+        update_statement, [document.get('package'), useremail, fieldvalue, document.get('batch')]))
+    if not document_ids:
         print("No existing record found for update!")
-    # return doccount
-    return doccount
+    return document_ids
+
+def get_package_assignments(packages, batch):
+    """
+    Expand a bulk packaging request into (package label, ItemId) pairs.
+
+    :type packages: dict
+    :param packages: The item ids to pack keyed by package label, either as a list of ItemIds or as a contiguous
+                     range of unit numbers of the batch such as {'from': 1, 'to': 40}.
+
+    :type batch: str
+    :param batch: The manufacturing batch number of the items.
+
+    :rtype: list
+    :return: The (package label, ItemId) pairs in request order.
+    """
+    assignments = []
+    for label, items in packages.items():
+        if isinstance(items, dict):
+            # Unit ItemIds are created as batch number + "000" + unit number
+            items = [batch+"000"+str(i) for i in range(int(items.get('from')), int(items.get('to'))+1)]
+        assignments.extend((label, item_id) for item_id in items)
+    return assignments
 
+def pack_item_chunk(executor, table_name, assignments, batch, useremail):
+    """
+    Assign the items of one chunk to their packages, with one UPDATE per package in the same transaction.
+
+    :type executor: :py:class:`pyqldb.execution.executor.Executor`
+    :param executor: An Executor object allowing for execution of statements within a transaction.
+
+    :type table_name: str
+    :param table_name: The table to update.
+
+    :type assignments: list
+    :param assignments: The (package label, ItemId) pairs of the chunk.
+
+    :type batch: str
+    :param batch: The manufacturing batch number of the items.
+
+    :type useremail: str
+    :param useremail: The new package owner.
+
+    :rtype: dict
+    :return: The updated document IDs keyed by package label.
+    """
+    item_ids_by_package = {}
+    for label, item_id in assignments:
+        item_ids_by_package.setdefault(label, []).append(item_id)
+    document_ids = {}
+    for label, item_ids in item_ids_by_package.items():
+        statement = "UPDATE {} As u SET u.PackageLabel = ?, u.PkgOwner = ? WHERE u.ItemSpecifications.MfgBatchNumber = ? AND u.ItemId IN ({})".format(
+            table_name, ', '.join('?' * len(item_ids)))
+        cursor = executor.execute_statement(statement, label, useremail, batch, *item_ids)
+        document_ids[label] = get_document_ids_from_dml_results(cursor)
+    return document_ids
+
+def update_item_packaging_bulk(driver, table_name, packages, batch, useremail, chunk_size=update_chunk_size):
+    """
+    Assign many items to packages, in transactions of at most `chunk_size` items.
+
+    :type driver: :py:class:`pyqldb.driver.qldb_driver.QldbDriver`
+    :param driver: An instance of the QldbDriver class.
+
+    :type table_name: str
+    :param table_name: The table to update.
+
+    :type packages: dict
+    :param packages: The item ids to pack keyed by package label, see `get_package_assignments`.
+
+    :type batch: str
+    :param batch: The manufacturing batch number of the items.
+
+    :type useremail: str
+    :param useremail: The new package owner.
+
+    :type chunk_size: int
+    :param chunk_size: The number of items updated per transaction.
+
+    :rtype: list
+    :return: The requested and updated item counts per package.
+    """
+    assignments = get_package_assignments(packages, batch)
+    results = {label: {'Package': label, 'Requested': 0, 'Updated': 0} for label, item_id in assignments}
+    for label, item_id in assignments:
+        results[label]['Requested'] += 1
+    for start in range(0, len(assignments), chunk_size):
+        chunk = assignments[start:start + chunk_size]
+        print('Packing items {} to {} of {}'.format(start + 1, start + len(chunk), len(assignments)))
+        document_ids = statement_tracer.execute_lambda(driver, lambda executor: pack_item_chunk(
+            executor, table_name, chunk, batch, useremail))
+        for label, ids in document_ids.items():
+            results[label]['Updated'] += len(ids)
+    return list(results.values())
+
+@statement_tracer.traced
 def lambda_handler(event, context):
     # Read the event paylaod for batch, package , activity, data
     API_flow = False
     processingerror = False
     return_msg = ''
+    document_ids = []
+    package_counts = None
     
     if event.get('body') is None:
         # pick from lambda test payload
@@ -123,7 +216,7 @@ def lambda_handler(event, context):
         activity = body_dict_payload.get('activity')
     # Initiate the business processing using QLDB driver object 
     try:
-        with create_qldb_driver(ledger_name) as driver:
+        with pooled_qldb_driver(ledger_name) as driver:
             # Fetch the authenticated user id, if invoked via auth flow else use default
             useremail = ''
             if event.get('requestContext').get('authorizer') is not None:
@@ -132,38 +225,45 @@ def lambda_handler(event, context):
                     print('Authorized user email on token - {}'.format(useremail))
                 
             if activity == 'Compliance':
-                doc_cnt = 0
                 if API_flow:
-                    doc_cnt = update_item_compliance(driver,"Item", body_dict_payload, 'MfgBatchNumber' , batch, data, useremail)
+                    document_ids = update_item_compliance(driver,"Item", body_dict_payload, 'MfgBatchNumber' , batch, data, useremail)
                 else:
-                    doc_cnt = update_item_compliance(driver,"Item", event, 'MfgBatchNumber' , batch, data, useremail)
-                print('Updated compliance for {} documents'.format(doc_cnt))
+                    document_ids = update_item_compliance(driver,"Item", event, 'MfgBatchNumber' , batch, data, useremail)
+                print('Updated compliance for {} documents'.format(len(document_ids)))
                 
-                if doc_cnt > 0:
+                if document_ids:
                     return_msg = 'Compliance details successfully updated'
                 else:
                     return_msg = 'Existing Item record not found for compliance update'
             
             if activity == 'Package':
-                doc_cnt = 0
                 if API_flow:
-                    doc_cnt = update_item_packaging(driver,"Item", body_dict_payload, 'ItemId' , data, useremail)
+                    document_ids = update_item_packaging(driver,"Item", body_dict_payload, 'ItemId' , data, useremail)
                 else:
-                    doc_cnt = update_item_packaging(driver,"Item", event, 'ItemId' , data, useremail)
-                print('Updated packaging for {} documents'.format(doc_cnt))
-                if doc_cnt > 0:
+                    document_ids = update_item_packaging(driver,"Item", event, 'ItemId' , data, useremail)
+                print('Updated packaging for {} documents'.format(len(document_ids)))
+                if document_ids:
                     return_msg = 'Item packaging details successfully updated'
                 else:
                     return_msg = 'Existing Item record not found for package update'
+
+            if activity == 'BulkPackage':
+                # data maps each package label to a list of ItemIds or a {'from', 'to'} unit range
+                package_counts = update_item_packaging_bulk(driver, "Item", data, batch, useremail)
+                updated = sum(count.get('Updated') for count in package_counts)
+                print('Updated packaging for {} documents'.format(updated))
+                if updated > 0:
+                    return_msg = 'Item packaging details successfully updated'
+                else:
+                    return_msg = 'Existing Item records not found for package update'
                     
             if activity == 'Coldchain':
-                doc_cnt = 0
                 if API_flow:
-                    doc_cnt = update_item_coldchain(driver,"Item", body_dict_payload, 'PackageLabel' , package, data, useremail)
+                    document_ids = update_item_coldchain(driver,"Item", body_dict_payload, 'PackageLabel' , package, data, useremail)
                 else:
-                    doc_cnt = update_item_coldchain(driver,"Item", event, 'PackageLabel' , package, data, useremail)
-                print('Updated coldchain for {} documents'.format(doc_cnt))
-                if doc_cnt > 0:
+                    document_ids = update_item_coldchain(driver,"Item", event, 'PackageLabel' , package, data, useremail)
+                print('Updated coldchain for {} documents'.format(len(document_ids)))
+                if document_ids:
                     return_msg = 'Item coldchain details successfully updated'
                 else:
                     return_msg = 'Existing Item record not found for coldchain update'                
@@ -175,7 +275,8 @@ def lambda_handler(event, context):
     response = {
         "isBase64Encoded": "false",
         "statusCode": 200,
-        "body": return_msg
+        "body": json.dumps({'Message': return_msg, 'DocumentIds': document_ids} if package_counts is None else
+                           {'Message': return_msg, 'Packages': package_counts})
     }
     
     return response
\ No newline at end of file
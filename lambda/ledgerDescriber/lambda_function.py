@@ -18,15 +18,9 @@
 
 # Functionality to check Ledger DB operational state
 
-from time import sleep
-from datetime import datetime
-from decimal import Decimal
-from boto3 import client
-from pyqldb.driver.qldb_driver import QldbDriver
-from common import create_qldb_driver 
-import json
+from common import get_qldb_client
 
-qldb_client = client('qldb')
+qldb_client = get_qldb_client()
 LEDGER_CREATION_POLL_PERIOD_SEC = 20
 ACTIVE_STATE = "ACTIVE"
 
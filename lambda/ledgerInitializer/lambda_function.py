@@ -18,21 +18,34 @@
 
 # Functionality to initialize Amaon QLDB Ledger
 
+from concurrent.futures import ThreadPoolExecutor
+from random import uniform
 from time import sleep
-from datetime import datetime
-from decimal import Decimal
-from boto3 import client
 from constants import Constants
-from common import create_qldb_driver 
-from pyqldb.driver.qldb_driver import QldbDriver
-import json
+from common import create_qldb_driver, get_qldb_client, StatementTracer
 import os
 
 
-qldb_client = client('qldb')
-LEDGER_CREATION_POLL_PERIOD_SEC = 20
+qldb_client = get_qldb_client()
 ACTIVE_STATE = "ACTIVE"
+CREATING_STATE = "CREATING"
 ledger_name = os.environ.get('LedgerNameString')
+statement_tracer = StatementTracer.from_environment('ledgerInitializer')
+
+def get_ledger_state(name):
+    """
+    Get the state of a ledger.
+
+    :type name: str
+    :param name: The ledger to check on.
+
+    :rtype: str
+    :return: The state of the ledger, or None when it does not exist.
+    """
+    try:
+        return qldb_client.describe_ledger(Name=name).get('State')
+    except qldb_client.exceptions.ResourceNotFoundException:
+        return None
 
 def create_ledger(name):
     """
@@ -49,25 +62,36 @@ def create_ledger(name):
     print('Success. Ledger state: {}.'.format(result.get('State')))
     return result
 
-def wait_for_active(name):
+def wait_for_active(name, base_delay_sec=Constants.LEDGER_POLL_BASE_DELAY_SEC,
+                    max_delay_sec=Constants.LEDGER_POLL_MAX_DELAY_SEC):
     """
-    Wait for the newly created ledger to become active.
+    Wait for the newly created ledger to become active. The ledger is polled often at first, then with a jittered
+    backoff growing up to the maximum delay.
 
     :type name: str
     :param name: The ledger to check on.
 
-    :rtype: dict
-    :return: Result from the request.
+    :type base_delay_sec: float
+    :param base_delay_sec: The first and shortest delay between two polls.
+
+    :type max_delay_sec: float
+    :param max_delay_sec: The longest delay between two polls.
+
+    :rtype: str
+    :return: The state of the ledger.
     """
     print('Waiting for ledger to become active...')
+    delay_sec = base_delay_sec
     while True:
-        result = qldb_client.describe_ledger(Name=name)
-        if result.get('State') == ACTIVE_STATE:
+        state = get_ledger_state(name)
+        if state == ACTIVE_STATE:
             print('Success. Ledger is active and ready to use.')
-            return result
-        print('The ledger is still creating. Please wait...')
-        sleep(LEDGER_CREATION_POLL_PERIOD_SEC)
-
+            return state
+        if state != CREATING_STATE:
+            raise ValueError('Ledger {} cannot become active, its state is {}'.format(name, state))
+        print('The ledger is still creating, checking again in {:.1f} s...'.format(delay_sec))
+        sleep(delay_sec)
+        delay_sec = min(max_delay_sec, uniform(base_delay_sec, delay_sec * 3))
 
 def create_table(driver, table_name):
     """
@@ -84,7 +108,7 @@ def create_table(driver, table_name):
     """
     print("Creating the '{}' table...".format(table_name))
     statement = 'CREATE TABLE {}'.format(table_name)
-    cursor = driver.execute_lambda(lambda executor: executor.execute_statement(statement))
+    cursor = statement_tracer.execute_lambda(driver, lambda executor: executor.execute_statement(statement))
     print('{} table created successfully.'.format(table_name))
     return len(list(cursor))
 
@@ -106,18 +130,127 @@ def create_index(driver, table_name, index_attribute):
     """
     print("Creating index on '{}'...".format(index_attribute))
     statement = 'CREATE INDEX on {} ({})'.format(table_name, index_attribute)
-    cursor = driver.execute_lambda(lambda executor: executor.execute_statement(statement))
+    cursor = statement_tracer.execute_lambda(driver, lambda executor: executor.execute_statement(statement))
+    return len(list(cursor))
+
+def drop_index(driver, table_name, index_id):
+    """
+    Drop an index of a particular table.
+
+    :type driver: :py:class:`pyqldb.driver.qldb_driver.QldbDriver`
+    :param driver: An instance of the QldbDriver class.
+
+    :type table_name: str
+    :param table_name: Name of the table to drop the index from.
+
+    :type index_id: str
+    :param index_id: The unique ID of the index.
+
+    :rtype: int
+    :return: The number of changes to the database.
+    """
+    print("Dropping failed index '{}' on '{}'...".format(index_id, table_name))
+    statement = 'DROP INDEX "{}" ON {} WITH (purge = true)'.format(index_id, table_name)
+    cursor = statement_tracer.execute_lambda(driver, lambda executor: executor.execute_statement(statement))
     return len(list(cursor))
 
+def get_existing_schema(driver):
+    """
+    Read the active tables of the ledger and their indexes.
+
+    :type driver: :py:class:`pyqldb.driver.qldb_driver.QldbDriver`
+    :param driver: An instance of the QldbDriver class.
+
+    :rtype: dict
+    :return: The indexes per table name, as dicts with their indexId and status keyed by indexed field.
+    """
+    statement = "SELECT name, indexes FROM information_schema.user_tables WHERE status = 'ACTIVE'"
+    rows = statement_tracer.execute_lambda(driver, lambda executor: list(executor.execute_statement(statement)))
+    schema = {}
+    for row in rows:
+        # index expressions are the indexed path, as in [ItemId]
+        schema[row.get('name')] = {index.get('expr').strip('[]'): index for index in row.get('indexes') or []}
+    return schema
+
+def get_missing_schema(existing_schema, manifest):
+    """
+    Compare the ledger schema with the manifest.
+
+    :type existing_schema: dict
+    :param existing_schema: The indexed fields per existing table, see `get_existing_schema`.
+
+    :type manifest: dict
+    :param manifest: The indexed fields per table the ledger must have.
+
+    :rtype: list
+    :return: (table name, whether the table is missing, fields to index, IDs of their failed indexes to drop first)
+             of the tables to provision.
+    """
+    missing = []
+    for table_name, fields in manifest.items():
+        indexes = existing_schema.get(table_name)
+        if indexes is None:
+            missing.append((table_name, True, list(fields), []))
+            continue
+        # A failed index still holds its field, it has to be dropped before the field can be indexed again
+        missing_fields = [field for field in fields if field not in indexes or indexes[field].get('status') == 'FAILED']
+        failed_index_ids = [indexes[field].get('indexId') for field in missing_fields if field in indexes]
+        if missing_fields:
+            missing.append((table_name, False, missing_fields, failed_index_ids))
+    return missing
+
+def provision_table(driver, table_name, create, fields, failed_index_ids):
+    """
+    Create a table if needed, drop its failed indexes and index the given fields, one statement after another.
+
+    :rtype: tuple
+    :return: The number of created tables and indexes.
+    """
+    if create:
+        create_table(driver, table_name)
+    for index_id in failed_index_ids:
+        drop_index(driver, table_name, index_id)
+    for field in fields:
+        create_index(driver, table_name, field)
+    return int(create), len(fields)
+
+def provision_schema(driver, manifest=Constants.TABLE_INDEXES):
+    """
+    Create the tables and indexes of the manifest which the ledger does not have yet.
+
+    :type driver: :py:class:`pyqldb.driver.qldb_driver.QldbDriver`
+    :param driver: An instance of the QldbDriver class.
+
+    :type manifest: dict
+    :param manifest: The indexed fields per table the ledger must have.
+
+    :rtype: tuple
+    :return: The number of created tables and indexes.
+    """
+    missing = get_missing_schema(get_existing_schema(driver), manifest)
+    if not missing:
+        print('Ledger schema is up to date')
+        return 0, 0
+    # Statements on the same table conflict with each other, tables are provisioned concurrently
+    with ThreadPoolExecutor(max_workers=len(missing)) as pool:
+        results = list(pool.map(lambda table: provision_table(driver, *table), missing))
+    return sum(tables for tables, indexes in results), sum(indexes for tables, indexes in results)
+
+@statement_tracer.traced
 def lambda_handler(event, context):
     processing_error = False
     return_msg = ''
     """
-    Create a ledger and wait for it to be active.
+    Create the ledger unless it exists and wait for it to be active.
     """
     try:
-        create_ledger(ledger_name)
-        wait_for_active(ledger_name)
+        state = get_ledger_state(ledger_name)
+        if state is None:
+            create_ledger(ledger_name)
+        else:
+            print('Ledger {} already exists, state: {}'.format(ledger_name, state))
+        if state != ACTIVE_STATE:
+            wait_for_active(ledger_name)
     except Exception as e:
         processing_error = True
         print('Unable to create the ledger! - {}'.format(e))
@@ -125,24 +258,17 @@ def lambda_handler(event, context):
 
     if not processing_error:
         """
-        Create required tables, Indexes
+        Create the missing tables, Indexes
         """
         try:
             with create_qldb_driver(ledger_name) as driver:
-                print('Creating tables on ledger...')
-                create_table(driver, Constants.ITEM_TABLE_NAME)
-                create_table(driver, Constants.SENSOR_TABLE_NAME)
-                print('Tables created successfully.')
-                print('Now, creating Indexes ..')
-                create_index(driver, Constants.ITEM_TABLE_NAME, Constants.ITEM_ID_INDEX_NAME)
-                create_index(driver, Constants.ITEM_TABLE_NAME, Constants.ITEM_MFG_BATCH_NUMBER_INDEX_NAME)
-                create_index(driver, Constants.ITEM_TABLE_NAME, Constants.ITEM_PKG_LABEL_INDEX_NAME)
-                create_index(driver, Constants.SENSOR_TABLE_NAME, Constants.SENSOR_ID_INDEX_NAME)
-                print('Index creation completed')        
+                print('Comparing the ledger schema with the manifest...')
+                tables, indexes = provision_schema(driver)
+                print('Created {} tables and {} indexes'.format(tables, indexes))
         except Exception as e:
             processing_error = True
-            print('Ledger Initialization process failed - {}',format(e))
-            return_msg = 'Ledger Initialization process failed - {}',format(e)
+            print('Ledger Initialization process failed - {}'.format(e))
+            return_msg = 'Ledger Initialization process failed - {}'.format(e)
 
     if not processing_error:
         return_msg = "Ledger Initialization completed successfully"
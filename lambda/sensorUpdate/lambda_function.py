@@ -18,24 +18,141 @@
 
 # Functionality to process sensor simulated events
 
-from time import sleep
-from datetime import datetime
-from decimal import Decimal
-from boto3 import client
-from common import convert_object_to_ion, to_base_64, create_qldb_driver
-from pyqldb.driver.qldb_driver import QldbDriver
+from base64 import b64decode
+from common import convert_object_to_ion, pooled_qldb_driver, prewarm_qldb_driver, get_document_ids_from_dml_results, \
+    LRUCache, StatementTracer
+from constants import Constants
+from thresholds import ReadingBuffer, ThresholdTable
 import json
 import os
 import uuid
 
-qldb_client = client('qldb')
 ledger_name = os.environ.get('LedgerNameString')
+statement_tracer = StatementTracer.from_environment('sensorUpdate')
+prewarm_qldb_driver(ledger_name)
+update_chunk_size = int(os.environ.get('UpdateChunkSize', Constants.UPDATE_CHUNK_SIZE))
+# Storage thresholds of the items per (package, batch), kept across warm invocations of this container
+threshold_cache = LRUCache(int(os.environ.get('ThresholdCacheSize', Constants.THRESHOLD_CACHE_SIZE)),
+                           float(os.environ.get('ThresholdCacheTtlSec', Constants.THRESHOLD_CACHE_TTL_SEC)))
+
+def get_temperature_range(payload):
+    """
+    Get the lowest and highest temperature of a Sensor document.
+
+    :type payload: dict
+    :param payload: A single reading, or a summary of readings carrying minTemp and maxTemp.
+
+    :rtype: tuple
+    :return: The lowest and highest temperature.
+    """
+    return payload.get('minTemp', payload.get('temp')), payload.get('maxTemp', payload.get('temp'))
+
+def get_package_thresholds(executor, table_name, fieldname, fieldvalue, batch):
+    """
+    Read the storage thresholds of the items of a package and batch.
+
+    :type executor: :py:class:`pyqldb.execution.executor.Executor`
+    :param executor: An Executor object allowing for execution of statements within a transaction.
+
+    :type table_name: str
+    :param table_name: The item table name.
+
+    :type fieldname: str
+    :param fieldname: The item field identifying the package.
+
+    :type fieldvalue: str
+    :param fieldvalue: The package to read.
+
+    :type batch: str
+    :param batch: The manufacturing batch to read.
+
+    :rtype: :py:class:`thresholds.ThresholdTable`
+    :return: The columnar storage thresholds of the items.
+    """
+    statement = "SELECT metadata.id , data.Storage.MaxTemperature, data.Storage.MinTemperature FROM _ql_committed_{} As p WHERE p.data.{} = ? AND p.data.ItemSpecifications.MfgBatchNumber = ?".format(table_name,fieldname)
+    print(statement)
+    return ThresholdTable.from_rows(executor.execute_statement(statement, fieldvalue, batch))
+
+def record_sensor_reading(executor, table_name, payload, fieldname, fieldvalue, batch, thresholds=None):
+    """
+    Log the sensor reading and mark the items whose storage range it violates, in the transaction of the executor.
+
+    :type executor: :py:class:`pyqldb.execution.executor.Executor`
+    :param executor: An Executor object allowing for execution of statements within a transaction.
+
+    :type table_name: str
+    :param table_name: The item table name.
+
+    :type payload: dict
+    :param payload: The Sensor document to insert, either a single reading or a summary of readings.
+
+    :type fieldname: str
+    :param fieldname: The item field identifying the package.
+
+    :type fieldvalue: str
+    :param fieldvalue: The package the reading belongs to.
+
+    :type batch: str
+    :param batch: The manufacturing batch the reading belongs to.
+
+    :type thresholds: :py:class:`thresholds.ThresholdTable`
+    :param thresholds: Cached thresholds of the package, see `get_package_thresholds`. They are read when omitted.
+
+    :rtype: tuple
+    :return: The thresholds of the package, the IDs of the violating documents and the IDs of those which were
+             updated, the ones past the transaction limit are left to the caller.
+    """
+    # A summary redelivered after its insert committed is logged once, only its violations are applied again
+    if next(executor.execute_statement('SELECT id FROM Sensor WHERE id = ?', payload.get('id')), None) is None:
+        executor.execute_statement('INSERT INTO Sensor ?', convert_object_to_ion(payload))
+    else:
+        print('Sensor record {} is already logged'.format(payload.get('id')))
+    if thresholds is None:
+        thresholds = get_package_thresholds(executor, table_name, fieldname, fieldvalue, batch)
+    min_temp, max_temp = get_temperature_range(payload)
+    if thresholds.in_range(min_temp, max_temp):
+        # Within the storage range of every item, no item needs to be read or written
+        return thresholds, [], []
+    violating_ids = thresholds.violating_ids(min_temp, max_temp)
+    # item coldchain is broken, update document seal & transaction ledger once for the violating items which fit in
+    # this transaction next to the sensor record, the rest is left to the caller
+    updated_ids = mark_items_violated(executor, table_name, violating_ids[:update_chunk_size - 1], payload, fieldname)
+    return thresholds, violating_ids, updated_ids
+
+def mark_items_violated(executor, table_name, document_ids, payload, fieldname):
+    """
+    Break the package seal of the given item documents with a single UPDATE. The package, batch and storage range are
+    checked again so that stale cached thresholds never mark an item wrongly.
+
+    :type executor: :py:class:`pyqldb.execution.executor.Executor`
+    :param executor: An Executor object allowing for execution of statements within a transaction.
+
+    :type table_name: str
+    :param table_name: The item table name.
+
+    :type document_ids: list
+    :param document_ids: The IDs of the violating item documents.
+
+    :type payload: dict
+    :param payload: The Sensor document reporting the violation.
+
+    :type fieldname: str
+    :param fieldname: The item field identifying the package.
+
+    :rtype: list
+    :return: The IDs of the updated documents.
+    """
+    if not document_ids:
+        return []
+    min_temp, max_temp = get_temperature_range(payload)
+    statement = "UPDATE {} As u BY id SET u.PackageSeal = ?, u.PackageChain.Status = ?, u.PackageChain.SensorRef = ? WHERE id IN ({}) AND u.{} = ? AND u.ItemSpecifications.MfgBatchNumber = ? AND (u.Storage.MaxTemperature < ? OR u.Storage.MinTemperature > ?)".format(
+        table_name, ', '.join('?' * len(document_ids)), fieldname)
+    print(statement)
+    cursor = executor.execute_statement(statement, '0', "Violated", payload.get('id'), *document_ids,
+                                        payload.get('package'), payload.get('batch'), max_temp, min_temp)
+    return get_document_ids_from_dml_results(cursor)
 
 def update_items_with_coldchain(driver,table_name, document, fieldname , fieldvalue):
-    processingerror = False
-    doccount = 0
-    #Log the sensor reading on the ledger tablele
-    print('Inserting sensor data in the Sensor table...')
     # create the payload for sensor insert 
     uid = uuid.uuid4()
     payload = {
@@ -44,53 +161,171 @@ def update_items_with_coldchain(driver,table_name, document, fieldname , fieldva
         "package" : document.get('package'),
         "temp" : document.get('data') 
     }
-    statement = 'INSERT INTO Sensor ?'
-    try:
-        cursor = driver.execute_lambda(lambda executor: executor.execute_statement(statement,convert_object_to_ion(payload)))
-        print("Sensor record added")
-    except Exception as e:
-        print('Sensor record insert failed - {}'.format(e))
-        processingerror = True
-            
-    if not processingerror:
-        print('Fetching Item records for any storage temperature violation..') 
-        statement = "SELECT metadata.id , data.Storage.MaxTemperature, data.Storage.MinTemperature, data.PackageSeal FROM _ql_committed_{} As p WHERE p.data.{} = '{}' AND p.data.ItemSpecifications.MfgBatchNumber = '{}'".format(table_name,fieldname, fieldvalue, document.get('batch'))
-        print(statement)
-        cursor = driver.execute_lambda(lambda executor: executor.execute_statement(statement))
-        # Check if there is any record in the cursor
-        first_record = next(cursor, None)
-        doccount = 0
-        if first_record:
-            print("Existing item record found for passed package and batch details..")
-            print("Validating sensor reported temperature data against individual item storage temperature ..")        
-            doccount = 0
-            sensor_temp = document.get('data')
-            return_msg = ''
-            for eachrow in cursor:
-                doc_id = eachrow['id']
-                max_temp = eachrow['MaxTemperature']
-                min_temp = eachrow['MinTemperature']
-                pkg_seal = eachrow['PackageSeal']
-                
-                if sensor_temp > max_temp or sensor_temp < min_temp:
-                    # item coldchain is broken, update document seal & transaction ledger
-                    pkg_seal = 0
-                    doccount = doccount + 1
-                    statement = "UPDATE {} As u SET u.PackageSeal = '{}', u.PackageChain.Status = '{}', u.PackageChain.SensorRef = '{}' WHERE u.PackageLabel = '{}' AND u.ItemSpecifications.MfgBatchNumber = '{}'".format(table_name,pkg_seal, "Violated", uid, fieldvalue,document.get('batch'))
-                    print(statement)
-                    cursor = driver.execute_lambda(lambda executor: executor.execute_statement(statement))
-                    if next(cursor, None):
-                        print('Updated package seal for - {}'.format(doc_id))
-                   
-            if doccount > 0:
-                print('Package coldchain successfully updated') 
-            else:
-                print("Temperature update Skipped!") 
+    return apply_sensor_payload(driver, table_name, payload, fieldname, fieldvalue)
+
+def apply_sensor_payload(driver, table_name, payload, fieldname, fieldvalue):
+    """
+    Log a Sensor document and break the package seal of the items whose storage range it violates.
+
+    :type driver: :py:class:`pyqldb.driver.qldb_driver.QldbDriver`
+    :param driver: An instance of the QldbDriver class.
+
+    :type table_name: str
+    :param table_name: The item table name.
+
+    :type payload: dict
+    :param payload: The Sensor document to insert.
+
+    :type fieldname: str
+    :param fieldname: The item field identifying the package.
+
+    :type fieldvalue: str
+    :param fieldvalue: The package the reading belongs to.
+
+    :rtype: int
+    :return: The number of updated item documents.
+    """
+    #Log the sensor reading on the ledger table and validate it in the same transaction
+    print('Inserting sensor data in the Sensor table and checking Item records for any storage temperature violation..')
+    key = (fieldvalue, payload.get('batch'))
+    cached_thresholds = threshold_cache.get(key)
+    thresholds, violating_ids, document_ids = statement_tracer.execute_lambda(
+        driver, lambda executor: record_sensor_reading(executor, table_name, payload, fieldname, fieldvalue,
+                                                       payload.get('batch'), cached_thresholds))
+    if cached_thresholds is None:
+        # Only fresh reads are cached, so that the entry expires with its time to live even for busy packages
+        threshold_cache.put(key, thresholds)
+    print("Sensor record added")
+    remaining_ids = violating_ids[update_chunk_size - 1:]
+    # QLDB allows up to 40 documents to be modified in a single transaction
+    for start in range(0, len(remaining_ids), update_chunk_size):
+        chunk = remaining_ids[start:start + update_chunk_size]
+        document_ids = document_ids + statement_tracer.execute_lambda(driver, lambda executor: mark_items_violated(
+            executor, table_name, chunk, payload, fieldname))
+    if len(document_ids) < len(violating_ids):
+        # Some items changed since their thresholds were cached, read them again next time
+        print('{} of {} violating items no longer matched, invalidating cached thresholds'.format(
+            len(violating_ids) - len(document_ids), len(violating_ids)))
+        threshold_cache.invalidate(key)
+    if not len(thresholds):
+        print("No existing item record found for passed package and batch details!")
+    elif document_ids:
+        print('Updated package seal for - {}'.format(', '.join(document_ids)))
+        print('Package coldchain successfully updated') 
+    else:
+        print("Temperature update Skipped!") 
+
+    return len(document_ids)
+
+def get_batch_readings(event):
+    """
+    Extract the sensor readings of an SQS or Kinesis batch event, or of a plain list of readings.
+
+    :type event: dict/list
+    :param event: The batch event, a plain list may also be passed as {'readings': [...]}.
+
+    :rtype: list
+    :return: (record identifier, reading) pairs, the reading is None for records which could not be parsed.
+    """
+    if isinstance(event, list):
+        records = [(str(index), reading) for index, reading in enumerate(event)]
+    elif event.get('readings') is not None:
+        records = [(str(index), reading) for index, reading in enumerate(event.get('readings'))]
+    else:
+        records = []
+        for record in event.get('Records', []):
+            identifier = None
+            try:
+                if record.get('kinesis') is not None:
+                    identifier = record.get('kinesis').get('sequenceNumber')
+                    reading = json.loads(b64decode(record.get('kinesis').get('data')))
+                else:
+                    identifier = record.get('messageId')
+                    reading = json.loads(record.get('body'))
+            except (TypeError, ValueError, AttributeError) as e:
+                print('Unreadable sensor record {} - {}'.format(identifier, e))
+                reading = None
+            records.append((identifier, reading))
+    readings = []
+    for identifier, reading in records:
+        if reading is not None and (not isinstance(reading, dict) or reading.get('package') is None
+                                    or reading.get('batch') is None or not isinstance(reading.get('data'), (int, float))):
+            print('Invalid sensor reading in record {} - {}'.format(identifier, reading))
+            reading = None
+        readings.append((identifier, reading))
+    return readings
+
+def group_readings(readings, unique_identifiers=False):
+    """
+    Collapse readings to the lowest and highest temperature per (package, batch).
+
+    :type readings: list
+    :param readings: (record identifier, reading) pairs of valid readings.
+
+    :type unique_identifiers: bool
+    :param unique_identifiers: Whether the record identifiers are unique, as SQS message IDs and Kinesis sequence
+                               numbers are. The id of each summary is then derived from its records, so that a
+                               group redelivered after a failure yields the same Sensor document.
+
+    :rtype: dict
+    :return: Sensor summary payloads keyed by (package, batch), along with the columnar readings and the identifiers
+             of their records.
+    """
+    groups = {}
+    for identifier, reading in readings:
+        key = (reading.get('package'), reading.get('batch'))
+        if key not in groups:
+            groups[key] = {'Readings': ReadingBuffer(), 'Records': []}
+        groups[key]['Readings'].append(reading.get('data'))
+        groups[key]['Records'].append(identifier)
+    for (package, batch), group in groups.items():
+        temperatures = group.get('Readings')
+        if unique_identifiers:
+            summary_id = uuid.uuid5(uuid.NAMESPACE_OID,
+                                    '{}/{}/{}'.format(package, batch, ','.join(sorted(group['Records']))))
         else:
-            print("No existing item record found for passed package and batch details!")
+            summary_id = uuid.uuid4()
+        # keep the latest reading as temp, next to the worst-case range
+        group['Payload'] = {"id": str(summary_id), "batch": batch, "package": package,
+                            "temp": temperatures.temperatures[-1], "minTemp": temperatures.min(),
+                            "maxTemp": temperatures.max(), "readingCount": len(temperatures)}
+    return groups
 
-    return doccount
+@statement_tracer.traced
+def batch_handler(event, context):
+    """
+    Process a batch of sensor readings with one Sensor summary write per (package, batch).
+
+    Records which cannot be parsed or whose group fails to be written are returned as batch item failures, so that
+    only they are retried by SQS or Kinesis. A group failing after its Sensor summary committed does not log it again
+    when retried, see `record_sensor_reading`.
+    """
+    readings = get_batch_readings(event)
+    failed_records = [identifier for identifier, reading in readings if reading is None]
+    groups = group_readings([(identifier, reading) for identifier, reading in readings if reading is not None],
+                            isinstance(event, dict) and event.get('Records') is not None)
+    print('Processing {} sensor readings in {} package groups'.format(len(readings), len(groups)))
+    processed_groups = set()
+    try:
+        with pooled_qldb_driver(ledger_name) as driver:
+            for (package, batch), group in groups.items():
+                try:
+                    doc_cnt = apply_sensor_payload(driver, "Item", group.get('Payload'), 'PackageLabel', package)
+                    print('Updated sensor data for {} documents of package {} batch {}'.format(doc_cnt, package, batch))
+                except Exception as e:
+                    print('Error inserting or updating documents for package {} batch {} - {}'.format(package, batch, e))
+                    failed_records.extend(group.get('Records'))
+                processed_groups.add((package, batch))
+            threshold_cache.log_stats('Threshold')
+    except Exception as e:
+        print('Error processing sensor batch - {}'.format(e))
+        # Groups already written are committed, retrying their records would apply them twice
+        for key, group in groups.items():
+            if key not in processed_groups:
+                failed_records.extend(group.get('Records'))
+    return {"batchItemFailures": [{"itemIdentifier": identifier} for identifier in failed_records]}
 
+@statement_tracer.traced
 def lambda_handler(event, context):
     # Read the event paylaod
     processingerror = False
@@ -113,9 +348,10 @@ def lambda_handler(event, context):
         temp_reading = body_dict_payload.get('data')
         document = body_dict_payload
     try:
-        with create_qldb_driver(ledger_name) as driver:
+        with pooled_qldb_driver(ledger_name) as driver:
             doc_cnt = update_items_with_coldchain(driver,"Item", document, 'PackageLabel' , package)
             print('Updated sensor data for {} documents'.format(doc_cnt))
+            threshold_cache.log_stats('Threshold')
             if doc_cnt > 0:
                 return_msg = 'Item coldchain details successfully updated'
             else:
@@ -0,0 +1,373 @@
+# /*
+#  * Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#  * SPDX-License-Identifier: MIT-0
+#  *
+#  * Permission is hereby granted, free of charge, to any person obtaining a copy of this
+#  * software and associated documentation files (the "Software"), to deal in the Software
+#  * without restriction, including without limitation the rights to use, copy, modify,
+#  * merge, publish, distribute, sublicense, and/or sell copies of the Software, and to
+#  * permit persons to whom the Software is furnished to do so.
+#  *
+#  * THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+#  * INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A
+#  * PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+#  * HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+#  * OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+#  * SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+#  */
+
+import json
+import os
+import shutil
+from base64 import b64decode
+
+from common import block_address_key, block_address_to_dictionary, to_base_64
+from verifier import build_candidate_digest, parse_block
+
+CHECKPOINT_DIRECTORY = '/tmp/checkpoints'
+# Most keys a DynamoDB BatchGetItem, and items a BatchWriteItem, accept per request
+DYNAMODB_BATCH_GET_SIZE = 100
+DYNAMODB_BATCH_WRITE_SIZE = 25
+
+
+class FileCheckpointStore:
+    """
+    Checkpoint store keeping one JSON file per key in a local directory.
+    On Lambda the directory lives in the container's /tmp, so a checkpoint is only visible to later invocations
+    served by the same container.
+    """
+
+    def __init__(self, directory=CHECKPOINT_DIRECTORY):
+        self.directory = directory
+
+    def _path(self, key):
+        return os.path.join(self.directory, '{}.json'.format(key))
+
+    def load(self, key):
+        """
+        Load the checkpoint saved under a key.
+
+        :type key: str
+        :param key: The checkpoint key.
+
+        :rtype: dict
+        :return: The saved state, or None if there is no checkpoint for the key.
+        """
+        try:
+            with open(self._path(key)) as checkpoint_file:
+                return json.load(checkpoint_file)
+        except FileNotFoundError:
+            return None
+
+    def save(self, key, state):
+        """
+        Save a checkpoint under a key, replacing any previous one atomically.
+
+        :type key: str
+        :param key: The checkpoint key.
+
+        :type state: dict
+        :param state: A JSON serializable state.
+        """
+        os.makedirs(self.directory, exist_ok=True)
+        temp_path = self._path(key) + '.tmp'
+        with open(temp_path, 'w') as checkpoint_file:
+            json.dump(state, checkpoint_file)
+        os.replace(temp_path, self._path(key))
+
+    def delete(self, key):
+        """
+        Delete the checkpoint saved under a key, along with the records of its namespace.
+        """
+        try:
+            os.remove(self._path(key))
+        except FileNotFoundError:
+            pass
+        shutil.rmtree(os.path.join(self.directory, key), ignore_errors=True)
+
+    def save_if_version(self, key, state, version):
+        """
+        Save a checkpoint under a key only if the saved one is still at the given version.
+
+        :type key: str
+        :param key: The checkpoint key.
+
+        :type state: dict
+        :param state: A JSON serializable state, with its new `Version`.
+
+        :type version: int
+        :param version: The `Version` of the saved checkpoint, None if there is none yet.
+
+        :rtype: bool
+        :return: True if the checkpoint was saved, False if it was changed in the meantime.
+        """
+        if (self.load(key) or {}).get('Version') != version:
+            return False
+        self.save(key, state)
+        return True
+
+    def _record_path(self, namespace, record_key):
+        return os.path.join(self.directory, namespace, '{}.txt'.format(record_key.replace('/', '_')))
+
+    def get_records(self, namespace, record_keys):
+        """
+        Read the records saved under a namespace, one file each.
+
+        :type namespace: str
+        :param namespace: The key the records belong to.
+
+        :type record_keys: list
+        :param record_keys: The record keys to read.
+
+        :rtype: dict
+        :return: The value of each record found.
+        """
+        records = {}
+        for record_key in record_keys:
+            try:
+                with open(self._record_path(namespace, record_key)) as record_file:
+                    records[record_key] = record_file.read()
+            except FileNotFoundError:
+                pass
+        return records
+
+    def put_records(self, namespace, records, expires_at=None):
+        """
+        Save records under a namespace, one file each.
+
+        :type namespace: str
+        :param namespace: The key the records belong to.
+
+        :type records: dict
+        :param records: The string value of each record key.
+
+        :type expires_at: int
+        :param expires_at: Epoch time in seconds after which the records may be removed, None to keep them. Local
+                           records are only removed along with their namespace, see `delete`.
+        """
+        os.makedirs(os.path.join(self.directory, namespace), exist_ok=True)
+        for record_key, value in records.items():
+            with open(self._record_path(namespace, record_key), 'w') as record_file:
+                record_file.write(value)
+
+
+class DynamoDBCheckpointStore:
+    """
+    Checkpoint store keeping each checkpoint as one item of a DynamoDB table with a string partition key `Key`,
+    so a job can be resumed from any container. Records of a namespace are items keyed `<namespace>#<record key>`;
+    records saved with an expiry hold it in `ExpiresAt`, to be removed by the table's time to live.
+    """
+
+    def __init__(self, table_name, dynamodb_client=None):
+        self.table_name = table_name
+        self._client = dynamodb_client
+
+    @property
+    def client(self):
+        if self._client is None:
+            from boto3 import client
+
+            self._client = client('dynamodb')
+        return self._client
+
+    def load(self, key):
+        result = self.client.get_item(TableName=self.table_name, Key={'Key': {'S': key}}, ConsistentRead=True)
+        item = result.get('Item')
+        if item is None:
+            return None
+        return json.loads(item['State']['S'])
+
+    def save(self, key, state):
+        self.client.put_item(TableName=self.table_name, Item={'Key': {'S': key}, 'State': {'S': json.dumps(state)}})
+
+    def delete(self, key):
+        self.client.delete_item(TableName=self.table_name, Key={'Key': {'S': key}})
+
+    def save_if_version(self, key, state, version):
+        if version is None:
+            condition, values = 'attribute_not_exists(#v)', {}
+        else:
+            condition, values = '#v = :v', {'ExpressionAttributeValues': {':v': {'N': str(version)}}}
+        try:
+            self.client.put_item(TableName=self.table_name,
+                                 Item={'Key': {'S': key}, 'State': {'S': json.dumps(state)},
+                                       'Version': {'N': str(state['Version'])}},
+                                 ConditionExpression=condition, ExpressionAttributeNames={'#v': 'Version'}, **values)
+        except self.client.exceptions.ConditionalCheckFailedException:
+            return False
+        return True
+
+    def get_records(self, namespace, record_keys):
+        records = {}
+        for start in range(0, len(record_keys), DYNAMODB_BATCH_GET_SIZE):
+            request = {self.table_name: {'Keys': [{'Key': {'S': '{}#{}'.format(namespace, record_key)}}
+                                                  for record_key in record_keys[start:start + DYNAMODB_BATCH_GET_SIZE]]}}
+            while request:
+                result = self.client.batch_get_item(RequestItems=request)
+                for item in result.get('Responses', {}).get(self.table_name, []):
+                    records[item['Key']['S'][len(namespace) + 1:]] = item['State']['S']
+                request = result.get('UnprocessedKeys')
+        return records
+
+    def put_records(self, namespace, records, expires_at=None):
+        expiry = {} if expires_at is None else {'ExpiresAt': {'N': str(int(expires_at))}}
+        items = [{'PutRequest': {'Item': dict({'Key': {'S': '{}#{}'.format(namespace, record_key)},
+                                               'State': {'S': value}}, **expiry)}}
+                 for record_key, value in records.items()]
+        for start in range(0, len(items), DYNAMODB_BATCH_WRITE_SIZE):
+            request = {self.table_name: items[start:start + DYNAMODB_BATCH_WRITE_SIZE]}
+            while request:
+                request = self.client.batch_write_item(RequestItems=request).get('UnprocessedItems')
+
+
+def create_checkpoint_store():
+    """
+    Create the checkpoint store configured for this function: a DynamoDB table when `CheckpointTableName` is set,
+    otherwise a local directory, `CheckpointDirectory` or /tmp/checkpoints.
+
+    :rtype: :py:class:`checkpoint.FileCheckpointStore`/:py:class:`checkpoint.DynamoDBCheckpointStore`
+    :return: The checkpoint store.
+    """
+    table_name = os.environ.get('CheckpointTableName')
+    if table_name:
+        return DynamoDBCheckpointStore(table_name)
+    return FileCheckpointStore(os.environ.get('CheckpointDirectory', CHECKPOINT_DIRECTORY))
+
+
+class DigestCheckpoint:
+    """
+    Trusted digest checkpoint, with the revisions already verified against it.
+
+    The checkpoint anchors on the block at its digest tip. A newer digest is accepted as extending the checkpoint
+    only if a proof fetched for that anchor block against the new `DigestTipAddress` rebuilds the new digest and
+    the block hash is unchanged. Every revision verified so far then stays trusted without new `get_revision`
+    calls, and the checkpoint moves forward to the new digest.
+
+    The anchor is a small versioned state saved only if no other container moved it in the meantime, while each
+    trusted revision is a record of its own, so the checkpoint does not grow with the revisions it covers.
+    """
+
+    def __init__(self, store, key, qldb_client, ledger_name):
+        self.store = store
+        self.key = key
+        self.qldb_client = qldb_client
+        self.ledger_name = ledger_name
+        # Whether the digest revisions are verified against is proven to extend the checkpoint
+        self.covers_digest = False
+        self._state = None
+        self._version = None
+        self._dirty = False
+        self._pending = {}
+
+    @property
+    def state(self):
+        if self._state is None:
+            self._state = self.store.load(self.key) or {}
+            self._version = self._state.get('Version')
+        return self._state
+
+    def _get_verified_block(self, block_address, digest):
+        """
+        Fetch a block with a proof against the given digest and return its hash if the proof holds.
+        """
+        result = self.qldb_client.get_block(Name=self.ledger_name, BlockAddress=block_address_to_dictionary(block_address),
+                                            DigestTipAddress=digest.get('DigestTipAddress'))
+        block_hash = parse_block(result.get('Block'))
+        if build_candidate_digest(result.get('Proof'), block_hash) != digest.get('Digest'):
+            return None
+        return bytes(block_hash)
+
+    def extend(self, digest):
+        """
+        Prove that a digest extends the checkpoint and move the checkpoint to it.
+
+        :type digest: dict
+        :param digest: The `Digest` and `DigestTipAddress` to extend the checkpoint to.
+
+        :rtype: bool
+        :return: True if the digest extends the checkpoint, or the checkpoint was established from it.
+                 False if the ledger no longer matches the checkpoint.
+        """
+        # Another container may have moved the checkpoint since it was loaded
+        self._state = None
+        self.covers_digest = False
+        tip_address = digest.get('DigestTipAddress').get('IonText')
+        anchor_address = self.state.get('DigestTipAddress')
+        if anchor_address is not None:
+            anchor_digest = {'Digest': b64decode(self.state['Digest']), 'DigestTipAddress': {'IonText': anchor_address}}
+            tip_key = block_address_key({'IonText': tip_address})
+            anchor_key = block_address_key({'IonText': anchor_address})
+            if tip_key == anchor_key and bytes(digest.get('Digest')) == anchor_digest['Digest']:
+                # The checkpoint digest itself, served again while the digest provider caches it
+                self.covers_digest = True
+                return True
+            if tip_key < anchor_key:
+                # An older digest cannot be proven to extend the checkpoint, only that its tip block is in the ledger
+                # the checkpoint covers. Revisions verified against it are then not recorded as trusted.
+                if self._get_verified_block(tip_address, anchor_digest) is None:
+                    print('Digest tip block at {} is not in the ledger of the trusted digest checkpoint at {}'.format(
+                        tip_address, anchor_address))
+                    return False
+                print('Digest at {} is older than the trusted digest checkpoint at {}'.format(tip_address, anchor_address))
+                return True
+            anchor_hash = self._get_verified_block(anchor_address, digest)
+            if anchor_hash is None or anchor_hash != b64decode(self.state['TipBlockHash']):
+                print('Digest at {} does not extend the trusted digest checkpoint at {}'.format(tip_address, anchor_address))
+                return False
+            print('Digest at {} extends the trusted digest checkpoint at {}'.format(tip_address, anchor_address))
+
+        tip_hash = self._get_verified_block(tip_address, digest)
+        if tip_hash is None:
+            print('Digest tip block at {} is not verified against its digest'.format(tip_address))
+            return False
+        self._state = {
+            'Digest': to_base_64(digest.get('Digest')),
+            'DigestTipAddress': tip_address,
+            'TipBlockHash': to_base_64(tip_hash),
+            'Version': (self._version or 0) + 1
+        }
+        self.covers_digest = True
+        self._dirty = True
+        return True
+
+    def _revision_key(self, document_id, block_address):
+        strand_id, sequence_no = block_address_key(block_address)
+        return '{}/{}/{}'.format(document_id, strand_id, sequence_no)
+
+    def get_trusted(self, revisions):
+        """
+        Check which revisions were already verified against the checkpoint.
+
+        :type revisions: list
+        :param revisions: The (document ID, block address, revision hash) of each revision.
+
+        :rtype: list
+        :return: For each revision, True if it is trusted with the given hash.
+        """
+        if 'TipBlockHash' not in self.state:
+            return [False] * len(revisions)
+        keys = [self._revision_key(document_id, block_address) for document_id, block_address, _ in revisions]
+        trusted_hashes = self.store.get_records(self.key, keys)
+        return [trusted_hashes.get(key) == to_base_64(bytes(revision_hash))
+                for key, (_, _, revision_hash) in zip(keys, revisions)]
+
+    def add(self, document_id, block_address, revision_hash):
+        """
+        Record a revision verified against a digest covered by the checkpoint.
+        """
+        if not self.covers_digest:
+            return
+        self._pending[self._revision_key(document_id, block_address)] = to_base_64(bytes(revision_hash))
+
+    def save(self):
+        if self._pending:
+            self.store.put_records(self.key, self._pending)
+            self._pending = {}
+        if self._dirty:
+            if not self.store.save_if_version(self.key, self.state, self._version):
+                # Both digests extend the same anchor, the revisions recorded against either one stay trusted
+                print('Trusted digest checkpoint {} was moved by another invocation, keeping it'.format(self.key))
+                self._state = None
+            else:
+                self._version = self._state['Version']
+            self._dirty = False
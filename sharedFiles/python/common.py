@@ -16,17 +16,36 @@
 #  * SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
 #  */
 
+from base64 import b64encode
+from collections import OrderedDict
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 from decimal import Decimal
+from functools import wraps
+from random import uniform
+from threading import Lock, Thread
+from time import monotonic, sleep, time
+import json
+import os
+import re
 
-from amazon.ion.simple_types import IonPyBool, IonPyBytes, IonPyDecimal, IonPyDict, IonPyFloat, IonPyInt, IonPyList, \
-    IonPyNull, IonPySymbol, IonPyText, IonPyTimestamp
-from amazon.ion.simpleion import dumps, loads
-from pyqldb.driver.qldb_driver import QldbDriver
-from base64 import encode, decode, b64encode, b64decode
+from constants import Constants
+from index_analyzer import check_statement, UnindexedStatementError
 
-IonValue = (IonPyBool, IonPyBytes, IonPyDecimal, IonPyDict, IonPyFloat, IonPyInt, IonPyList, IonPyNull, IonPySymbol,
-            IonPyText, IonPyTimestamp)
+# Ion, boto3 and pyqldb are imported by the functions using them, so that handlers only pay for what they use when
+# their container starts
+
+THROTTLING_ERROR_CODES = ('ThrottlingException', 'TooManyRequestsException', 'LimitExceededException',
+                          'RateExceededException', 'RequestLimitExceeded')
+
+STATEMENT_LITERALS = re.compile(r"'(?:[^']|'')*'|`[^`]*`|\b\d+(?:\.\d+)?\b")
+STATEMENT_PARAMETER_LISTS = re.compile(r'\?(?:\s*,\s*\?)+')
+
+# Metrics recorded per statement template, with their CloudWatch units
+# pyqldb cursors only report read IOs
+STATEMENT_METRICS = {'Executions': 'Count', 'WallTimeMs': 'Milliseconds', 'ReadIOs': 'Count',
+                     'ProcessingTimeMs': 'Milliseconds', 'Retries': 'Count', 'OccRetries': 'Count'}
 
 def convert_object_to_ion(py_object):
     """
@@ -38,10 +57,69 @@ def convert_object_to_ion(py_object):
     :rtype: :py:class:`amazon.ion.simple_types.IonPyValue`
     :return: The converted Ion object.
     """
-    ion_object = loads(dumps(py_object))
+    from amazon.ion.core import IonType
+    from amazon.ion.simple_types import IonPyBool, IonPyBytes, IonPyDecimal, IonPyDict, IonPyFloat, IonPyInt, \
+        IonPyList, IonPyNull, IonPySymbol, IonPyText, IonPyTimestamp
+    from amazon.ion.simpleion import dumps, loads
+
+    ion_values = (IonPyBool, IonPyBytes, IonPyDecimal, IonPyDict, IonPyFloat, IonPyInt, IonPyList, IonPyNull,
+                  IonPySymbol, IonPyText, IonPyTimestamp)
+    # Ion types of the Python values which can be converted without going through the Ion serializer, bool must come
+    # before int since it is a subclass of it
+    python_to_ion_types = ((bool, IonPyBool, IonType.BOOL), (int, IonPyInt, IonType.INT),
+                           (float, IonPyFloat, IonType.FLOAT), (Decimal, IonPyDecimal, IonType.DECIMAL),
+                           (str, IonPyText, IonType.STRING), (bytes, IonPyBytes, IonType.BLOB),
+                           (datetime, IonPyTimestamp, IonType.TIMESTAMP))
+
+    def convert(value):
+        if isinstance(value, ion_values):
+            return value
+        if value is None:
+            return IonPyNull.from_value(IonType.NULL, None)
+        if isinstance(value, dict):
+            ion_struct = IonPyDict.from_value(IonType.STRUCT, {})
+            for key, field_value in value.items():
+                ion_struct[key] = convert(field_value)
+            return ion_struct
+        if isinstance(value, (list, tuple)):
+            return IonPyList.from_value(IonType.LIST, [convert(element) for element in value])
+        for py_type, ion_class, ion_type in python_to_ion_types:
+            if isinstance(value, py_type):
+                return ion_class.from_value(ion_type, value)
+        return loads(dumps(value))
+
+    ion_object = convert(py_object)
     return ion_object
 
 
+class IonDocumentTemplate:
+    """
+    An Ion struct converted once from a Python dictionary, to create many documents which only differ in a few
+    top-level fields.
+    """
+
+    def __init__(self, py_object):
+        self._template = convert_object_to_ion(py_object)
+
+    def render(self, **fields):
+        """
+        Create a document from the template, converting only the given fields.
+
+        :type fields: dict
+        :param fields: The top-level fields to set on the document.
+
+        :rtype: :py:class:`amazon.ion.simple_types.IonPyDict`
+        :return: The Ion document, sharing the unchanged values with the template.
+        """
+        from amazon.ion.core import IonType
+        from amazon.ion.simple_types import IonPyDict
+
+        document = IonPyDict.from_value(IonType.STRUCT, self._template)
+        for key, value in fields.items():
+            document[key] = convert_object_to_ion(value)
+        return document
+
+
 def to_ion_struct(key, value):
     """
     Convert the given key and value into an Ion struct.
@@ -57,7 +135,7 @@ def to_ion_struct(key, value):
     """
     ion_struct = dict()
     ion_struct[key] = value
-    return loads(str(ion_struct))
+    return convert_object_to_ion(ion_struct)
 
 
 def get_document_ids(transaction_executor, table_name, field, value):
@@ -109,6 +187,8 @@ def print_result(cursor):
     :rtype: int
     :return: Number of documents in the result set.
     """
+    from amazon.ion.simpleion import dumps
+
     result_counter = 0
     for row in cursor:
         # Each row would be in Ion format.
@@ -136,6 +216,23 @@ def block_address_to_dictionary(ion_dict):
     return block_address
 
 
+def block_address_key(block_address):
+    """
+    Return a hashable (strandId, sequenceNo) key for a block address.
+
+    :type block_address: :py:class:`amazon.ion.simple_types.IonPyDict`/dict
+    :param block_address: A block address from a query result, or a value holder such as `DigestTipAddress`.
+
+    :rtype: tuple
+    :return: The strand ID and sequence number of the block.
+    """
+    if 'IonText' in block_address:
+        from amazon.ion.simpleion import loads
+
+        block_address = loads(block_address['IonText'])
+    return str(block_address['strandId']), int(block_address['sequenceNo'])
+
+
 def value_holder_to_string(value_holder):
     """
     Returns the string representation of a given `value_holder`.
@@ -146,6 +243,8 @@ def value_holder_to_string(value_holder):
     :rtype: str
     :return: The string representation of the supplied `value_holder`.
     """
+    from amazon.ion.simpleion import dumps, loads
+
     ret_val = dumps(loads(value_holder), binary=False, indent='  ', omit_version_marker=True)
     val = '{{ IonText: {}}}'.format(ret_val)
     return val
@@ -190,7 +289,8 @@ def digest_response_to_string(digest_response):
 
     return '{' + string + '}'
     
-def create_qldb_driver(ledger_name, region_name=None, endpoint_url=None, boto3_session=None):
+def create_qldb_driver(ledger_name, region_name=None, endpoint_url=None, boto3_session=None, retry_config=None,
+                       max_concurrent_transactions=0):
     """
     Create a QLDB driver for executing transactions.
 
@@ -206,15 +306,187 @@ def create_qldb_driver(ledger_name, region_name=None, endpoint_url=None, boto3_s
     :type boto3_session: :py:class:`boto3.session.Session`
     :param boto3_session: The boto3 session to create the client with (see [1]).
 
+    :type retry_config: :py:class:`pyqldb.config.retry_config.RetryConfig`
+    :param retry_config: The driver level retry config, the driver default is used when omitted.
+
+    :type max_concurrent_transactions: int
+    :param max_concurrent_transactions: The session pool limit, 0 to use the client connection pool size.
+
     :rtype: :py:class:`pyqldb.driver.qldb_driver.QldbDriver`
     :return: A QLDB driver object.
 
     [1]: `Boto3 Session.client Reference <https://boto3.amazonaws.com/v1/documentation/api/latest/reference/core/session.html#boto3.session.Session.client>`.
     """
+    from botocore.config import Config
+    from pyqldb.driver.qldb_driver import QldbDriver
+
+    config = None
+    if max_concurrent_transactions:
+        # The session pool cannot be larger than the client connection pool
+        config = Config(max_pool_connections=max(10, max_concurrent_transactions))
     qldb_driver = QldbDriver(ledger_name=ledger_name, region_name=region_name, endpoint_url=endpoint_url,
-                             boto3_session=boto3_session)
+                             boto3_session=boto3_session, retry_config=retry_config, config=config,
+                             max_concurrent_transactions=max_concurrent_transactions)
     return qldb_driver
     
+class LazyClient:
+    """
+    A boto3 client created on first use, so that importing a handler does not load the service model. Attribute
+    access is forwarded to the client.
+    """
+
+    def __init__(self, service_name):
+        self.service_name = service_name
+        self._client = None
+        self._lock = Lock()
+
+    def get_client(self):
+        """
+        :return: The boto3 client, created on the first call.
+        """
+        if self._client is None:
+            with self._lock:
+                if self._client is None:
+                    from boto3 import client
+
+                    self._client = client(self.service_name)
+        return self._client
+
+    def __getattr__(self, name):
+        return getattr(self.get_client(), name)
+
+
+_qldb_client = LazyClient('qldb')
+
+
+def get_qldb_client():
+    """
+    Get the QLDB control plane client shared by the handlers of the container, created on first use.
+
+    :rtype: :py:class:`common.LazyClient`
+    :return: The shared QLDB client.
+    """
+    return _qldb_client
+
+
+# Drivers kept for the lifetime of the container, keyed by ledger name
+_pooled_drivers = {}
+_pooled_drivers_lock = Lock()
+
+
+def is_qldb_driver_healthy(driver):
+    """
+    Check that a driver can still run a transaction against its ledger.
+
+    :type driver: :py:class:`pyqldb.driver.qldb_driver.QldbDriver`
+    :param driver: The driver to check.
+
+    :rtype: bool
+    :return: True if the table names of the ledger could be listed.
+    """
+    try:
+        list(driver.list_tables())
+        return True
+    except Exception as e:
+        print('QLDB driver health check failed - {}'.format(e))
+        return False
+
+
+def get_qldb_driver(ledger_name, max_concurrent_transactions=Constants.MAX_CONCURRENT_TRANSACTIONS,
+                    health_check_idle_sec=Constants.DRIVER_HEALTH_CHECK_IDLE_SEC):
+    """
+    Get the pooled QLDB driver of the ledger, created on first use and reused by every warm invocation of the
+    container so that sessions and HTTP connections are not set up again. The driver must not be closed by the
+    caller.
+
+    :type ledger_name: str
+    :param ledger_name: The QLDB ledger name.
+
+    :type max_concurrent_transactions: int
+    :param max_concurrent_transactions: The session pool limit, only used when the driver is created.
+
+    :type health_check_idle_sec: float
+    :param health_check_idle_sec: A driver idle for longer is checked before being returned, and replaced if the check
+                                  fails.
+
+    :rtype: :py:class:`pyqldb.driver.qldb_driver.QldbDriver`
+    :return: A QLDB driver object.
+    """
+    with _pooled_drivers_lock:
+        entry = _pooled_drivers.get(ledger_name)
+        now = monotonic()
+        if entry is not None and now - entry['LastUsed'] > health_check_idle_sec and \
+                not is_qldb_driver_healthy(entry['Driver']):
+            print('Reconnecting QLDB driver for ledger {}'.format(ledger_name))
+            entry['Driver'].close()
+            entry = None
+        if entry is None:
+            entry = {'Driver': create_qldb_driver(ledger_name, max_concurrent_transactions=max_concurrent_transactions)}
+            _pooled_drivers[ledger_name] = entry
+        entry['LastUsed'] = now
+        return entry['Driver']
+
+
+@contextmanager
+def pooled_qldb_driver(ledger_name, max_concurrent_transactions=Constants.MAX_CONCURRENT_TRANSACTIONS):
+    """
+    Context manager form of `get_qldb_driver`, the pooled driver is left open on exit. It is dropped if it was found
+    closed, so that the next invocation reconnects.
+
+    :type ledger_name: str
+    :param ledger_name: The QLDB ledger name.
+
+    :type max_concurrent_transactions: int
+    :param max_concurrent_transactions: The session pool limit, only used when the driver is created.
+
+    :rtype: :py:class:`pyqldb.driver.qldb_driver.QldbDriver`
+    :return: A QLDB driver object.
+    """
+    from pyqldb.errors import DriverClosedError
+
+    try:
+        yield get_qldb_driver(ledger_name, max_concurrent_transactions)
+    except DriverClosedError:
+        reset_qldb_driver(ledger_name)
+        raise
+
+
+def reset_qldb_driver(ledger_name):
+    """
+    Close and drop the pooled QLDB driver of the ledger, the next `get_qldb_driver` call creates a new one.
+
+    :type ledger_name: str
+    :param ledger_name: The QLDB ledger name.
+    """
+    with _pooled_drivers_lock:
+        entry = _pooled_drivers.pop(ledger_name, None)
+    if entry is not None:
+        entry['Driver'].close()
+
+
+def prewarm_qldb_driver(ledger_name, max_concurrent_transactions=Constants.MAX_CONCURRENT_TRANSACTIONS):
+    """
+    Create the pooled QLDB driver of the ledger and open a session with it, meant to be called while the Lambda
+    container initializes so that warm invocations reuse its sessions. Failures are logged and the driver is
+    dropped, to be created again on first use.
+
+    :type ledger_name: str
+    :param ledger_name: The QLDB ledger name.
+
+    :type max_concurrent_transactions: int
+    :param max_concurrent_transactions: The session pool limit.
+    """
+    if not ledger_name:
+        return
+    try:
+        driver = get_qldb_driver(ledger_name, max_concurrent_transactions)
+    except Exception as e:
+        print('Unable to create QLDB driver for ledger {} - {}'.format(ledger_name, e))
+        return
+    if not is_qldb_driver_healthy(driver):
+        reset_qldb_driver(ledger_name)
+
+
 def to_base_64(input):
     """
     Encode input in base64.
@@ -226,4 +498,556 @@ def to_base_64(input):
     :return: Return input that has been encoded in base64.
     """
     encoded_value = b64encode(input)
-    return str(encoded_value, 'UTF-8')
\ No newline at end of file
+    return str(encoded_value, 'UTF-8')
+
+
+def is_throttling_error(error):
+    """
+    Check whether an error raised by a boto3 client call was caused by request throttling.
+
+    :type error: Exception
+    :param error: The error raised by the client.
+
+    :rtype: bool
+    :return: True if the request was throttled and is safe to retry.
+    """
+    response = getattr(error, 'response', None) or {}
+    return response.get('Error', {}).get('Code') in THROTTLING_ERROR_CODES
+
+
+class TokenBucket:
+    """
+    Thread-safe token bucket limiting the rate of control-plane calls.
+
+    The refill rate adapts to the service: it is halved whenever a call is throttled and recovers additively on
+    each successful call, up to the configured rate.
+    """
+
+    def __init__(self, rate=Constants.PROOF_FETCH_RATE_PER_SEC, capacity=None, min_rate=1):
+        self.max_rate = float(rate)
+        self.min_rate = float(min(min_rate, rate))
+        self.rate = self.max_rate
+        self.capacity = float(capacity if capacity is not None else rate)
+        self._tokens = self.capacity
+        self._updated = monotonic()
+        self._lock = Lock()
+
+    def acquire(self):
+        """
+        Block until a token is available and take it.
+        """
+        while True:
+            with self._lock:
+                now = monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self.rate
+            sleep(wait)
+
+    def on_success(self):
+        with self._lock:
+            self.rate = min(self.max_rate, self.rate + 1)
+
+    def on_throttle(self):
+        with self._lock:
+            self.rate = max(self.min_rate, self.rate / 2)
+
+
+def call_with_retry(function, args, limiter=None, retry_limit=Constants.RETRY_LIMIT):
+    """
+    Call a function, retrying throttled calls with full-jitter exponential backoff.
+
+    :type function: function
+    :param function: The function to call.
+
+    :type args: tuple
+    :param args: Positional arguments for the function.
+
+    :type limiter: :py:class:`common.TokenBucket`
+    :param limiter: Optional rate limiter to take a token from before every attempt.
+
+    :type retry_limit: int
+    :param retry_limit: Maximum number of retries after the first attempt.
+
+    :return: The value returned by the function.
+    """
+    attempt = 0
+    while True:
+        if limiter is not None:
+            limiter.acquire()
+        try:
+            result = function(*args)
+        except Exception as e:
+            if not is_throttling_error(e) or attempt >= retry_limit:
+                raise
+            if limiter is not None:
+                limiter.on_throttle()
+            delay = uniform(0, min(Constants.RETRY_MAX_DELAY_SEC, Constants.RETRY_BASE_DELAY_SEC * 2 ** attempt))
+            print('Request throttled, retrying in {:.2f}s (attempt {} of {})'.format(delay, attempt + 1, retry_limit))
+            sleep(delay)
+            attempt += 1
+            continue
+        if limiter is not None:
+            limiter.on_success()
+        return result
+
+
+def fetch_all(function, args_list, max_workers=Constants.PROOF_FETCH_CONCURRENCY, limiter=None):
+    """
+    Run a control-plane fetch such as `get_revision` or `get_block` for every argument tuple on a bounded thread
+    pool, throttled by a shared token bucket.
+
+    :type function: function
+    :param function: The fetch function to call.
+
+    :type args_list: list
+    :param args_list: A list of positional argument tuples, one per call.
+
+    :type max_workers: int
+    :param max_workers: Maximum number of concurrent calls.
+
+    :type limiter: :py:class:`common.TokenBucket`
+    :param limiter: The rate limiter to share between the calls, a new one is used when omitted.
+
+    :rtype: list
+    :return: The results of the calls, in the same order as `args_list`.
+    """
+    args_list = list(args_list)
+    if not args_list:
+        return []
+    if limiter is None:
+        limiter = TokenBucket()
+    with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(args_list)))) as pool:
+        return list(pool.map(lambda args: call_with_retry(function, args, limiter), args_list))
+
+
+def is_occ_conflict(error):
+    """
+    Check whether an error returned by QLDB is an optimistic concurrency control conflict.
+
+    :type error: :py:class:`Exception`
+    :param error: The error to check.
+
+    :rtype: bool
+    :return: True if the transaction was rejected because of an OCC conflict.
+    """
+    response = getattr(error, 'response', None) or {}
+    return response.get('Error', {}).get('Code') == 'OccConflictException'
+
+
+class DecorrelatedJitterBackoff:
+    """
+    A `RetryConfig` custom backoff using decorrelated jitter, each delay is drawn between the base delay and three
+    times the previous one. Use one instance per transaction to keep the retry counts apart.
+    """
+
+    def __init__(self, base_ms=Constants.RETRY_BASE_DELAY_SEC * 1000, cap_ms=Constants.RETRY_MAX_DELAY_SEC * 1000):
+        self.base_ms = base_ms
+        self.cap_ms = cap_ms
+        self.retries = 0
+        self.occ_conflicts = 0
+        self._delay_ms = base_ms
+
+    def __call__(self, retry_attempt, error, transaction_id):
+        self.retries += 1
+        if is_occ_conflict(error):
+            self.occ_conflicts += 1
+        self._delay_ms = min(self.cap_ms, uniform(self.base_ms, self._delay_ms * 3))
+        print('Transaction {} failed ({}), retrying in {:.0f} ms'.format(transaction_id, type(error).__name__,
+                                                                         self._delay_ms))
+        return self._delay_ms
+
+    def retry_config(self, retry_limit=Constants.RETRY_LIMIT):
+        """
+        Create a retry config using this backoff.
+
+        :type retry_limit: int
+        :param retry_limit: Maximum number of retries after the first attempt.
+
+        :rtype: :py:class:`pyqldb.config.retry_config.RetryConfig`
+        :return: The retry config to pass to `execute_lambda`.
+        """
+        from pyqldb.config.retry_config import RetryConfig
+
+        return RetryConfig(retry_limit=retry_limit, custom_backoff=self)
+
+
+def statement_template(statement, max_length=Constants.TRACE_STATEMENT_MAX_LENGTH):
+    """
+    Reduce a PartiQL statement to its template, so that executions with different values are aggregated together.
+    Literals are replaced by parameters and parameter lists of any length are collapsed.
+
+    :type statement: str
+    :param statement: The PartiQL statement.
+
+    :type max_length: int
+    :param max_length: Maximum length of the template, it is used as a metric dimension.
+
+    :rtype: str
+    :return: The statement template.
+    """
+    template = STATEMENT_PARAMETER_LISTS.sub('?, ...', STATEMENT_LITERALS.sub('?', statement))
+    return ' '.join(template.split())[:max_length]
+
+
+class TracingExecutor:
+    """
+    Wrap the executor of a transaction to check the index coverage of the statements it runs, and record them along
+    with their cursors.
+    """
+
+    def __init__(self, executor, tracer, executions):
+        self._executor = executor
+        self._tracer = tracer
+        self._executions = executions
+
+    def execute_statement(self, statement, *parameters):
+        template = statement_template(statement)
+        self._tracer.check_indexes(statement, template)
+        start = monotonic()
+        cursor = self._executor.execute_statement(statement, *parameters)
+        self._executions.append((template, cursor, (monotonic() - start) * 1000))
+        return cursor
+
+    def __getattr__(self, name):
+        return getattr(self._executor, name)
+
+
+class StatementTracer:
+    """
+    Aggregate the cost of the PartiQL statements run by a handler per statement template: wall time, retries of the
+    transactions running them, and the consumed IOs and server processing time reported by the QLDB cursors. The
+    totals are printed as CloudWatch embedded metric format lines when the invocation ends.
+
+    Statements are checked against the declared indexes before they run, see `index_analyzer`. The index check mode
+    is off, warn to print the statements without an index lookup, or strict to refuse them.
+    """
+
+    def __init__(self, handler_name, namespace=Constants.METRICS_NAMESPACE,
+                 index_check_mode=Constants.INDEX_CHECK_MODE):
+        self.handler_name = handler_name
+        self.namespace = namespace
+        self.index_check_mode = index_check_mode
+        self._statements = {}
+        self._index_checks = {}
+        self._lock = Lock()
+
+    @classmethod
+    def from_environment(cls, handler_name):
+        """
+        Create the tracer of a handler, configured by the `MetricsNamespace` and `IndexCheckMode` variables.
+
+        :type handler_name: str
+        :param handler_name: The handler name, used as metric dimension.
+
+        :rtype: :py:class:`common.StatementTracer`
+        :return: The statement tracer.
+        """
+        return cls(handler_name, os.environ.get('MetricsNamespace', Constants.METRICS_NAMESPACE),
+                   os.environ.get('IndexCheckMode', Constants.INDEX_CHECK_MODE))
+
+    def check_indexes(self, statement, template):
+        """
+        Check the index coverage of a statement before it runs.
+
+        :type statement: str
+        :param statement: The PartiQL statement.
+
+        :type template: str
+        :param template: The template of the statement, see `statement_template`.
+
+        :raises UnindexedStatementError: In strict mode, when the statement has no index lookup.
+        """
+        if self.index_check_mode == 'off':
+            return
+        with self._lock:
+            analysis = self._index_checks.get(template)
+            if analysis is None:
+                # Warn once per statement template while the container lives
+                analysis = self._index_checks[template] = check_statement(statement)
+        if analysis.get('Indexed') is False and self.index_check_mode == 'strict':
+            raise UnindexedStatementError('Statement refused by the strict index check - {}'.format(template))
+
+    def record(self, template, **metrics):
+        with self._lock:
+            totals = self._statements.setdefault(template, dict.fromkeys(STATEMENT_METRICS, 0))
+            for name, value in metrics.items():
+                totals[name] += value
+
+    def execute_lambda(self, driver, query_lambda, retry_config=None):
+        """
+        Run a transaction through the driver and record the statements it executes.
+
+        :type driver: :py:class:`pyqldb.driver.qldb_driver.QldbDriver`
+        :param driver: An instance of the QldbDriver class.
+
+        :type query_lambda: function
+        :param query_lambda: The transaction body, called with a tracing executor.
+
+        :type retry_config: :py:class:`pyqldb.config.retry_config.RetryConfig`
+        :param retry_config: Optional retry config, the one of the driver is used when omitted.
+
+        :return: The result of `query_lambda`.
+        """
+        executions = []
+        retries = {'Retries': 0, 'OccRetries': 0}
+        try:
+            return driver.execute_lambda(lambda executor: query_lambda(TracingExecutor(executor, self, executions)),
+                                         self.counting_retry_config(driver, retry_config, retries))
+        finally:
+            # Stream cursors hold the IOs and timing of every page read, including the attempts which were retried
+            for template, cursor, wall_time_ms in executions:
+                consumed_ios = cursor.get_consumed_ios() or {}
+                timing = cursor.get_timing_information() or {}
+                self.record(template, Executions=1, WallTimeMs=wall_time_ms, ReadIOs=consumed_ios.get('ReadIOs', 0),
+                            ProcessingTimeMs=timing.get('ProcessingTimeMilliseconds', 0))
+            # Retries are charged to each statement of the transaction
+            for template in set(template for template, cursor, wall_time_ms in executions):
+                self.record(template, **retries)
+
+    @staticmethod
+    def counting_retry_config(driver, retry_config, retries):
+        """
+        Copy a retry config so that its backoff also counts the retries and OCC conflicts.
+
+        :type driver: :py:class:`pyqldb.driver.qldb_driver.QldbDriver`
+        :param driver: The driver whose retry config is copied when `retry_config` is None.
+
+        :type retry_config: :py:class:`pyqldb.config.retry_config.RetryConfig`
+        :param retry_config: The retry config to copy.
+
+        :type retries: dict
+        :param retries: The Retries and OccRetries counters to increment.
+
+        :rtype: :py:class:`pyqldb.config.retry_config.RetryConfig`
+        :return: The counting retry config.
+        """
+        from pyqldb.config.retry_config import RetryConfig
+        from pyqldb.util.retry import Retry
+
+        retry_config = retry_config or getattr(driver, '_retry_config', None) or RetryConfig()
+
+        def backoff(retry_attempt, error, transaction_id):
+            retries['Retries'] += 1
+            if is_occ_conflict(error):
+                retries['OccRetries'] += 1
+            return Retry.calculate_backoff(retry_config, retry_attempt, error, transaction_id)
+
+        return RetryConfig(retry_limit=retry_config.retry_limit, base=retry_config.base, custom_backoff=backoff)
+
+    def flush(self):
+        """
+        Print one embedded metric format line per statement template recorded since the last flush.
+        """
+        with self._lock:
+            statements, self._statements = self._statements, {}
+        timestamp = int(time() * 1000)
+        for template, totals in statements.items():
+            print(json.dumps(dict(totals, Handler=self.handler_name, Statement=template, _aws={
+                'Timestamp': timestamp,
+                'CloudWatchMetrics': [{'Namespace': self.namespace, 'Dimensions': [['Handler', 'Statement']],
+                                       'Metrics': [{'Name': name, 'Unit': unit}
+                                                   for name, unit in STATEMENT_METRICS.items()]}]})))
+
+    def traced(self, handler):
+        """
+        Decorate a Lambda handler to flush the statement metrics at the end of each invocation.
+        """
+        @wraps(handler)
+        def traced_handler(event, context):
+            try:
+                return handler(event, context)
+            finally:
+                self.flush()
+        return traced_handler
+
+
+class LRUCache:
+    """
+    Thread-safe cache bounded by size, evicting the least recently used entry, with an optional time to live.
+    Hits and misses are counted so callers can log the cache effectiveness.
+    """
+
+    def __init__(self, max_size, ttl_sec=None):
+        self.max_size = max_size
+        self.ttl_sec = ttl_sec
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = Lock()
+
+    def get(self, key, is_valid=None):
+        """
+        Get a cached value.
+
+        :type key: object
+        :param key: The cache key.
+
+        :type is_valid: function
+        :param is_valid: Optional predicate on the cached value, an entry it rejects is evicted.
+
+        :return: The cached value, or None on a miss.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                value, stored = entry
+                expired = self.ttl_sec is not None and monotonic() - stored > self.ttl_sec
+                if not expired and (is_valid is None or is_valid(value)):
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self._entries[key]
+            self.misses += 1
+            return None
+
+    def put(self, key, value):
+        with self._lock:
+            self._entries[key] = (value, monotonic())
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def log_stats(self, name):
+        print('{} cache - hits: {}, misses: {}, entries: {}'.format(name, self.hits, self.misses, len(self)))
+
+
+class VerificationCache:
+    """
+    Container-scoped cache of verified document revisions, keyed by (document ID, block address).
+
+    Each entry keeps the verified revision hash and the sequence number of the digest tip it was verified against.
+    An entry is reused while the current ledger tip is at most `max_staleness` blocks past that tip.
+    """
+
+    def __init__(self, max_size=Constants.VERIFICATION_CACHE_SIZE, ttl_sec=Constants.VERIFICATION_CACHE_TTL_SEC,
+                 max_staleness=Constants.VERIFICATION_CACHE_MAX_STALENESS):
+        self.max_staleness = max_staleness
+        self._entries = LRUCache(max_size, ttl_sec)
+
+    def get(self, document_id, block_address, tip_sequence_no):
+        """
+        Get the verified revision hash of a document revision.
+
+        :type document_id: str
+        :param document_id: The document ID.
+
+        :type block_address: :py:class:`amazon.ion.simple_types.IonPyDict`
+        :param block_address: The block address of the revision.
+
+        :type tip_sequence_no: int
+        :param tip_sequence_no: The sequence number of the current digest tip.
+
+        :rtype: bytes
+        :return: The revision hash, or None if the revision has not been verified recently enough.
+        """
+        key = (str(document_id), block_address_key(block_address))
+        entry = self._entries.get(key, lambda value: tip_sequence_no - value[1] <= self.max_staleness)
+        return entry[0] if entry is not None else None
+
+    def put(self, document_id, block_address, revision_hash, tip_sequence_no):
+        key = (str(document_id), block_address_key(block_address))
+        self._entries.put(key, (bytes(revision_hash), tip_sequence_no))
+
+    def log_stats(self):
+        self._entries.log_stats('Verification')
+
+
+class DigestProvider:
+    """
+    Container-scoped source of the ledger digest, replacing a `get_digest` call per verification.
+
+    A digest is served as is for `ttl_sec` after it was fetched. For up to `max_stale_sec` after that it is still
+    served while a single background refresh runs, so requests do not wait on `GetDigest`. Older digests, or a
+    digest whose tip does not cover a revision the caller needs to verify, are refreshed before returning.
+    """
+
+    def __init__(self, qldb_client, ledger_name, ttl_sec=Constants.DIGEST_TTL_SEC,
+                 max_stale_sec=Constants.DIGEST_MAX_STALE_SEC):
+        self.qldb_client = qldb_client
+        self.ledger_name = ledger_name
+        self.ttl_sec = ttl_sec
+        self.max_stale_sec = max_stale_sec
+        self.fetches = 0
+        self._digest = None
+        self._fetched = 0
+        self._refreshing = False
+        self._lock = Lock()
+
+    @classmethod
+    def from_environment(cls, qldb_client, ledger_name):
+        """
+        Create the digest provider of a ledger, configured by the `DigestTtlSec` and `DigestMaxStaleSec` variables.
+
+        :type qldb_client: :py:class:`botocore.client.BaseClient`
+        :param qldb_client: The QLDB control plane client.
+
+        :type ledger_name: str
+        :param ledger_name: The QLDB ledger name.
+
+        :rtype: :py:class:`common.DigestProvider`
+        :return: The digest provider.
+        """
+        return cls(qldb_client, ledger_name, float(os.environ.get('DigestTtlSec', Constants.DIGEST_TTL_SEC)),
+                   float(os.environ.get('DigestMaxStaleSec', Constants.DIGEST_MAX_STALE_SEC)))
+
+    def _fetch(self):
+        print("Let's get the current digest of the ledger named {}".format(self.ledger_name))
+        result = call_with_retry(lambda: self.qldb_client.get_digest(Name=self.ledger_name), ())
+        digest = {'Digest': result.get('Digest'), 'DigestTipAddress': result.get('DigestTipAddress')}
+        with self._lock:
+            self._digest = digest
+            self._fetched = monotonic()
+            self.fetches += 1
+        return digest
+
+    def _background_refresh(self):
+        try:
+            self._fetch()
+        except Exception as e:
+            print('Background digest refresh failed - {}'.format(e))
+        finally:
+            with self._lock:
+                self._refreshing = False
+
+    def get_digest(self, min_sequence_no=None):
+        """
+        Get a recent digest of the ledger's journal.
+
+        :type min_sequence_no: int
+        :param min_sequence_no: Optional sequence number of the newest block the digest must cover.
+
+        :rtype: dict
+        :return: The `Digest` and the `DigestTipAddress` it covers.
+        """
+        with self._lock:
+            digest = self._digest
+            age = monotonic() - self._fetched
+        if digest is None or age > self.ttl_sec + self.max_stale_sec:
+            return self._fetch()
+        if min_sequence_no is not None and block_address_key(digest['DigestTipAddress'])[1] < min_sequence_no:
+            return self._fetch()
+        if age > self.ttl_sec:
+            with self._lock:
+                start_refresh = not self._refreshing
+                self._refreshing = True
+            if start_refresh:
+                Thread(target=self._background_refresh, daemon=True).start()
+        return digest
+
+    @property
+    def digest_tip_address(self):
+        """
+        The `DigestTipAddress` of the most recently fetched digest, so callers can group proofs against it.
+        """
+        return self._digest['DigestTipAddress'] if self._digest is not None else None
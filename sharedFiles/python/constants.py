@@ -23,8 +23,49 @@ class Constants:
     ITEM_ID_INDEX_NAME = "ItemId"
     ITEM_MFG_BATCH_NUMBER_INDEX_NAME = "MfgBatchNumber"
     ITEM_PKG_LABEL_INDEX_NAME = "PackageLabel"
-    SENSOR_ID_INDEX_NAME = "Id"
-    SENSOR_RDG_BATCH_INDEX_NAME = "Batch"
-    SENSOR_RDG_PKG_INDEX_NAME = "Package"
+    # Sensor documents are written by sensorUpdate with lower case field names
+    SENSOR_ID_INDEX_NAME = "id"
+    SENSOR_RDG_BATCH_INDEX_NAME = "batch"
+    SENSOR_RDG_PKG_INDEX_NAME = "package"
+    # Schema manifest: the tables of the ledger and their indexed top-level fields, provisioned by ledgerInitializer
+    # and checked by index_analyzer
+    TABLE_INDEXES = {
+        ITEM_TABLE_NAME: (ITEM_ID_INDEX_NAME, ITEM_MFG_BATCH_NUMBER_INDEX_NAME, ITEM_PKG_LABEL_INDEX_NAME),
+        SENSOR_TABLE_NAME: (SENSOR_ID_INDEX_NAME, SENSOR_RDG_BATCH_INDEX_NAME, SENSOR_RDG_PKG_INDEX_NAME)
+    }
     
-    RETRY_LIMIT = 4
\ No newline at end of file
+    RETRY_LIMIT = 4
+    RETRY_BASE_DELAY_SEC = 0.1
+    RETRY_MAX_DELAY_SEC = 5
+
+    LEDGER_POLL_BASE_DELAY_SEC = 1
+    LEDGER_POLL_MAX_DELAY_SEC = 20
+
+    MAX_CONCURRENT_TRANSACTIONS = 10
+    DRIVER_HEALTH_CHECK_IDLE_SEC = 300
+
+    PROOF_FETCH_CONCURRENCY = 8
+    PROOF_FETCH_RATE_PER_SEC = 20
+
+    VERIFICATION_JOB_SLICE_SIZE = 200
+    VERIFICATION_JOB_TIME_MARGIN_MS = 30000
+    VERIFICATION_JOB_TTL_SEC = 604800
+
+    VERIFICATION_CACHE_SIZE = 1024
+    VERIFICATION_CACHE_TTL_SEC = 300
+    VERIFICATION_CACHE_MAX_STALENESS = 0
+
+    DIGEST_TTL_SEC = 30
+    DIGEST_MAX_STALE_SEC = 300
+
+    INSERT_CHUNK_SIZE = 40
+    INSERT_CONCURRENCY = 8
+    UPDATE_CHUNK_SIZE = 40
+
+    THRESHOLD_CACHE_SIZE = 1024
+    THRESHOLD_CACHE_TTL_SEC = 60
+    EXISTENCE_CHECK_CHUNK_SIZE = 200
+
+    METRICS_NAMESPACE = "TrackAndTrace"
+    TRACE_STATEMENT_MAX_LENGTH = 256
+    INDEX_CHECK_MODE = "warn"
@@ -0,0 +1,305 @@
+# /*
+#  * Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#  * SPDX-License-Identifier: MIT-0
+#  *
+#  * Permission is hereby granted, free of charge, to any person obtaining a copy of this
+#  * software and associated documentation files (the "Software"), to deal in the Software
+#  * without restriction, including without limitation the rights to use, copy, modify,
+#  * merge, publish, distribute, sublicense, and/or sell copies of the Software, and to
+#  * permit persons to whom the Software is furnished to do so.
+#  *
+#  * THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+#  * INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A
+#  * PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+#  * HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+#  * OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+#  * SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+#  */
+
+# Index coverage of PartiQL statements against the indexes declared in Constants.TABLE_INDEXES
+#
+# QLDB only uses an index for an equality or IN predicate on an indexed top-level field, or on the document ID.
+# Any other lookup scans the table, which is slow and makes the transaction conflict with every concurrent write
+# to the table. history() can only be looked up by document ID.
+#
+# Usage: python sharedFiles/python/index_analyzer.py [--strict] [--bind name=value ...] [file ...]
+# Without files, the statements built by every lambda/*/lambda_function.py are reported.
+
+from collections import OrderedDict
+import os
+import re
+
+from constants import Constants
+
+PATH = r'(?:[A-Za-z_]\w*|\?)(?:\.(?:[A-Za-z_]\w*|\?))*'
+SOURCE = re.compile(r'\b(?:FROM|UPDATE)\s+(?:history\(\s*(?P<history>\w+|\?)\s*\)|_ql_committed_(?P<committed>\w+|\?)|'
+                    r'(?P<catalog>information_schema\.\w+)|(?P<table>\w+|\?))'
+                    r'(?:\s+AS)?(?:\s+(?!WHERE\b|BY\b|SET\b)(?P<alias>[A-Za-z_]\w*))?'
+                    r'(?:\s+BY\s+(?P<document_id>[A-Za-z_]\w*))?', re.IGNORECASE)
+WHERE = re.compile(r'\bWHERE\b', re.IGNORECASE)
+LOOKUP = re.compile(r'(?<![\w.<>!])(?P<path>' + PATH + r')\s*(?P<operator>=|\bIN\b)', re.IGNORECASE)
+
+INDEXED = 'indexed'
+DOCUMENT_ID = 'document ID'
+
+
+class UnindexedStatementError(ValueError):
+    """
+    Raised in strict mode for a statement which has no index lookup.
+    """
+
+
+def get_sources(statement):
+    """
+    Get the tables a statement reads or updates.
+
+    :type statement: str
+    :param statement: The PartiQL statement.
+
+    :rtype: list
+    :return: One dict per source, with its Table, Kind (table, committed, history or catalog), Alias and DocumentId
+             variable.
+    """
+    sources = []
+    for match in SOURCE.finditer(statement):
+        kind = 'history' if match.group('history') else 'committed' if match.group('committed') else \
+            'catalog' if match.group('catalog') else 'table'
+        sources.append({'Table': match.group('history') or match.group('committed') or match.group('catalog') or
+                        match.group('table'),
+                        'Kind': kind, 'Alias': match.group('alias'), 'DocumentId': match.group('document_id')})
+    return sources
+
+
+def resolve_field(source, path):
+    """
+    Resolve a predicate path to a field of its source.
+
+    :type source: dict
+    :param source: The source of the path, see `get_sources`.
+
+    :type path: list
+    :param path: The path components, without the source alias.
+
+    :rtype: str
+    :return: The dotted field path, 'metadata.id' for the document ID, or None when the path is not a field.
+    """
+    if source.get('DocumentId') is not None and path == [source.get('DocumentId')]:
+        return 'metadata.id'
+    if source.get('Kind') != 'table' or path[:1] == ['metadata']:
+        # committed views and history expose the document under data, next to its metadata
+        if path[:1] == ['data'] and len(path) > 1:
+            path = path[1:]
+        elif path[:1] != ['metadata']:
+            return None
+    return '.'.join(path)
+
+
+def classify_lookup(source, field, table_indexes):
+    """
+    Check whether a lookup on a field can use an index.
+
+    :rtype: tuple
+    :return: Whether an index is used, True, False or None when the statement is not fully known, and the reason.
+    """
+    table = source.get('Table')
+    if '?' in field or table == '?':
+        return None, 'unresolved {}.{}'.format(table, field)
+    if field == 'metadata.id':
+        return True, DOCUMENT_ID
+    if source.get('Kind') == 'history':
+        return False, 'history({}) is only indexed by document ID'.format(table)
+    if '.' in field:
+        return False, 'nested field {}, only top-level fields can be indexed'.format(field)
+    if field in table_indexes.get(table, ()):
+        return True, INDEXED
+    return False, 'no index on {}.{}'.format(table, field)
+
+
+def analyze_statement(statement, table_indexes=None):
+    """
+    Check the equality and IN predicates of a statement against the declared indexes.
+
+    :type statement: str
+    :param statement: The PartiQL statement, parameters and literals are ignored.
+
+    :type table_indexes: dict
+    :param table_indexes: Indexed top-level fields per table, Constants.TABLE_INDEXES when omitted.
+
+    :rtype: dict
+    :return: The Statement, its Lookups with the Table, Field, Operator, Indexed flag and Reason of each, and
+             whether the statement is Indexed: True when a lookup uses an index, None when no lookup is needed or
+             the statement is not fully resolved, False otherwise.
+    """
+    if table_indexes is None:
+        table_indexes = Constants.TABLE_INDEXES
+    analysis = {'Statement': statement, 'Lookups': [], 'Indexed': None}
+    sources = get_sources(statement)
+    if not sources or re.match(r'\s*(INSERT|CREATE|DROP|UNDROP)\b', statement, re.IGNORECASE):
+        return analysis
+    if any(source.get('Kind') == 'catalog' for source in sources):
+        # the system catalog is small and never written by transactions
+        return analysis
+    where = WHERE.search(statement)
+    if where is None:
+        analysis['Indexed'] = False
+        analysis['Lookups'].append({'Table': sources[0].get('Table'), 'Field': None, 'Operator': None,
+                                    'Indexed': False, 'Reason': 'no WHERE clause, full scan'})
+        return analysis
+    # literals may contain anything looking like a predicate
+    clause = re.sub(r"'(?:[^']|'')*'", '?', statement[where.end():])
+    aliases = dict((source.get('Alias'), source) for source in sources if source.get('Alias'))
+    for match in LOOKUP.finditer(clause):
+        path = match.group('path').split('.')
+        source = aliases.get(path[0])
+        if source is not None:
+            path = path[1:]
+        else:
+            source = sources[0]
+        field = resolve_field(source, path) if path else None
+        if field is None:
+            continue
+        indexed, reason = classify_lookup(source, field, table_indexes)
+        analysis['Lookups'].append({'Table': source.get('Table'), 'Field': field,
+                                    'Operator': match.group('operator').upper(), 'Indexed': indexed,
+                                    'Reason': reason})
+    flags = [lookup.get('Indexed') for lookup in analysis['Lookups']]
+    if True in flags:
+        analysis['Indexed'] = True
+    elif None not in flags:
+        analysis['Indexed'] = False
+        if not flags:
+            analysis['Lookups'].append({'Table': sources[0].get('Table'), 'Field': None, 'Operator': None,
+                                        'Indexed': False, 'Reason': 'no equality or IN predicate, full scan'})
+    return analysis
+
+
+def check_statement(statement, strict=False, table_indexes=None):
+    """
+    Analyze a statement before running it.
+
+    :type statement: str
+    :param statement: The PartiQL statement.
+
+    :type strict: bool
+    :param strict: Refuse the statement when it has no index lookup.
+
+    :type table_indexes: dict
+    :param table_indexes: Indexed top-level fields per table, Constants.TABLE_INDEXES when omitted.
+
+    :rtype: dict
+    :return: The analysis of the statement, see `analyze_statement`.
+
+    :raises UnindexedStatementError: In strict mode, when the statement has no index lookup.
+    """
+    analysis = analyze_statement(statement, table_indexes)
+    if analysis.get('Indexed') is False:
+        reasons = '; '.join(OrderedDict.fromkeys(lookup.get('Reason') for lookup in analysis.get('Lookups')))
+        if strict:
+            raise UnindexedStatementError('Statement has no index lookup ({}) - {}'.format(reasons, statement))
+        print('Statement has no index lookup ({}) - {}'.format(reasons, statement))
+    return analysis
+
+
+def render_format(node, bindings):
+    """
+    Render a `str.format` call of the AST with its known arguments: string literals, Constants attributes and bound
+    names. Any other argument is rendered as a parameter.
+    """
+    import ast
+
+    def render(argument):
+        if isinstance(argument, ast.Constant) and isinstance(argument.value, str):
+            return argument.value
+        if isinstance(argument, ast.Name) and argument.id in bindings:
+            return bindings.get(argument.id)
+        if isinstance(argument, ast.Attribute) and isinstance(argument.value, ast.Name) \
+                and argument.value.id == 'Constants' and isinstance(getattr(Constants, argument.attr, None), str):
+            return getattr(Constants, argument.attr)
+        return '?'
+
+    try:
+        return node.func.value.value.format(*[render(argument) for argument in node.args],
+                                            **dict((keyword.arg, render(keyword.value)) for keyword in node.keywords))
+    except (IndexError, KeyError):
+        return None
+
+
+def find_statements(source, bindings=None):
+    """
+    Find the PartiQL statements built as string literals, or formatted from one, in Python source code.
+
+    :type source: str
+    :param source: The Python source code.
+
+    :type bindings: dict
+    :param bindings: Values of the names passed to `str.format`, like the table name.
+
+    :rtype: list
+    :return: (line number, statement) pairs.
+    """
+    import ast
+
+    bindings = bindings or {}
+    statement_start = re.compile(r'\s*(SELECT|UPDATE|DELETE)\b', re.IGNORECASE)
+    statements = []
+    formatted = set()
+    nodes = list(ast.walk(ast.parse(source)))
+    for node in nodes:
+        if isinstance(node, ast.Call) and isinstance(node.func, ast.Attribute) and node.func.attr == 'format' \
+                and isinstance(node.func.value, ast.Constant) and isinstance(node.func.value.value, str):
+            formatted.add(node.func.value)
+            if statement_start.match(node.func.value.value):
+                statement = render_format(node, bindings)
+                if statement is not None:
+                    statements.append((node.lineno, statement))
+    for node in nodes:
+        if isinstance(node, ast.Constant) and isinstance(node.value, str) and node not in formatted \
+                and statement_start.match(node.value):
+            statements.append((node.lineno, node.value))
+    return sorted(set(statements))
+
+
+def report(paths, bindings=None, table_indexes=None):
+    """
+    Print the index coverage of the statements built by the given files.
+
+    :rtype: int
+    :return: The number of statements without an index lookup.
+    """
+    unindexed = 0
+    for path in paths:
+        with open(path) as source:
+            statements = find_statements(source.read(), bindings)
+        for line, statement in statements:
+            analysis = analyze_statement(statement, table_indexes)
+            status = {True: 'OK', False: 'SCAN', None: '-'}.get(analysis.get('Indexed'))
+            if analysis.get('Indexed') is False:
+                unindexed += 1
+            print('{:<5} {}:{} {}'.format(status, os.path.relpath(path), line, statement))
+            for lookup in analysis.get('Lookups'):
+                print('      {} {} {} - {}'.format(lookup.get('Table'), lookup.get('Field'), lookup.get('Operator'),
+                                                 lookup.get('Reason')))
+    print('{} statements without an index lookup'.format(unindexed))
+    return unindexed
+
+
+def main(arguments=None):
+    import argparse
+    import glob
+
+    parser = argparse.ArgumentParser(description='Report the index coverage of the PartiQL statements of the handlers')
+    parser.add_argument('files', nargs='*', help='Python files to scan, every lambda handler by default')
+    parser.add_argument('--bind', action='append', default=[], metavar='NAME=VALUE',
+                        help='value of a name passed to str.format, table_name=Item by default')
+    parser.add_argument('--strict', action='store_true', help='fail when a statement has no index lookup')
+    options = parser.parse_args(arguments)
+    bindings = {'table_name': Constants.ITEM_TABLE_NAME}
+    bindings.update(binding.split('=', 1) for binding in options.bind)
+    root = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, os.pardir)
+    files = options.files or sorted(glob.glob(os.path.join(root, 'lambda', '*', 'lambda_function.py')))
+    unindexed = report(files, bindings)
+    return 1 if options.strict and unindexed else 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
@@ -0,0 +1,164 @@
+# /*
+#  * Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#  * SPDX-License-Identifier: MIT-0
+#  *
+#  * Permission is hereby granted, free of charge, to any person obtaining a copy of this
+#  * software and associated documentation files (the "Software"), to deal in the Software
+#  * without restriction, including without limitation the rights to use, copy, modify,
+#  * merge, publish, distribute, sublicense, and/or sell copies of the Software, and to
+#  * permit persons to whom the Software is furnished to do so.
+#  *
+#  * THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+#  * INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A
+#  * PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+#  * HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+#  * OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+#  * SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+#  */
+
+# Columnar sensor readings and item storage thresholds, checked for coldchain violations in vectorized operations
+
+from array import array
+
+# NumPy is optional and imported on first use, the checks fall back to the standard library array module when it is
+# not installed
+_numpy = None
+
+
+def get_numpy():
+    """
+    Import NumPy on first use.
+
+    :rtype: module
+    :return: The numpy module, None if it is not installed.
+    """
+    global _numpy
+    if _numpy is None:
+        try:
+            import numpy
+            _numpy = numpy
+        except ImportError:
+            _numpy = False
+    return _numpy or None
+
+
+class ReadingBuffer:
+    """
+    Columnar buffer of sensor temperature readings, stored as a contiguous array of doubles.
+    """
+
+    def __init__(self, temperatures=()):
+        self.temperatures = array('d', temperatures)
+
+    def append(self, temperature):
+        self.temperatures.append(temperature)
+
+    def __len__(self):
+        return len(self.temperatures)
+
+    def min(self):
+        """
+        :rtype: float
+        :return: The lowest temperature in the buffer.
+        """
+        numpy = get_numpy()
+        if numpy is not None:
+            return float(numpy.frombuffer(self.temperatures, dtype=numpy.float64).min())
+        return min(self.temperatures)
+
+    def max(self):
+        """
+        :rtype: float
+        :return: The highest temperature in the buffer.
+        """
+        numpy = get_numpy()
+        if numpy is not None:
+            return float(numpy.frombuffer(self.temperatures, dtype=numpy.float64).max())
+        return max(self.temperatures)
+
+
+class ThresholdTable:
+    """
+    Columnar storage thresholds of the items of a package. The Ion rows are read once when the table is built, the
+    checks then only touch arrays of doubles.
+    """
+
+    def __init__(self, document_ids, min_limits, max_limits):
+        self.document_ids = list(document_ids)
+        self.min_limits = array('d', min_limits)
+        self.max_limits = array('d', max_limits)
+        # The envelope in which a temperature is within the range of every item
+        self.min_limit = max(self.min_limits) if self.min_limits else None
+        self.max_limit = min(self.max_limits) if self.max_limits else None
+
+    @classmethod
+    def from_rows(cls, rows, id_field='id', min_field='MinTemperature', max_field='MaxTemperature'):
+        """
+        Build a table from query result rows.
+
+        :type rows: iterable
+        :param rows: The rows holding the document id and the storage range of every item.
+
+        :type id_field: str
+        :param id_field: The field holding the document id.
+
+        :type min_field: str
+        :param min_field: The field holding the minimum storage temperature.
+
+        :type max_field: str
+        :param max_field: The field holding the maximum storage temperature.
+
+        :rtype: :py:class:`thresholds.ThresholdTable`
+        :return: The threshold table.
+        """
+        document_ids = []
+        min_limits = array('d')
+        max_limits = array('d')
+        for row in rows:
+            document_ids.append(row[id_field])
+            min_limits.append(float(row[min_field]))
+            max_limits.append(float(row[max_field]))
+        return cls(document_ids, min_limits, max_limits)
+
+    def __len__(self):
+        return len(self.document_ids)
+
+    def in_range(self, min_temp, max_temp):
+        """
+        Check whether a temperature range is within the storage range of every item.
+
+        :type min_temp: float
+        :param min_temp: The lowest temperature reported.
+
+        :type max_temp: float
+        :param max_temp: The highest temperature reported.
+
+        :rtype: bool
+        :return: True if no item is violated.
+        """
+        return not self.document_ids or (min_temp >= self.min_limit and max_temp <= self.max_limit)
+
+    def violating_ids(self, min_temp, max_temp):
+        """
+        Get the items whose storage range is violated by a temperature range. Every reading of a batch is covered by
+        checking its lowest and highest temperature.
+
+        :type min_temp: float
+        :param min_temp: The lowest temperature reported.
+
+        :type max_temp: float
+        :param max_temp: The highest temperature reported.
+
+        :rtype: list
+        :return: The document ids of the violated items.
+        """
+        if self.in_range(min_temp, max_temp):
+            return []
+        numpy = get_numpy()
+        if numpy is not None:
+            mask = (numpy.frombuffer(self.max_limits, dtype=numpy.float64) < max_temp) | \
+                   (numpy.frombuffer(self.min_limits, dtype=numpy.float64) > min_temp)
+            return [self.document_ids[index] for index in numpy.flatnonzero(mask)]
+        return [document_id for document_id, min_limit, max_limit in zip(self.document_ids, self.min_limits,
+                                                                          self.max_limits)
+                if max_temp > max_limit or min_temp < min_limit]
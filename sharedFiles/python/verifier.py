@@ -18,14 +18,14 @@
 
 from array import array
 from base64 import b64encode
+from collections import OrderedDict
 from functools import reduce
 from hashlib import sha256
 from random import randrange
 
-from amazon.ion.simpleion import loads
-
 HASH_LENGTH = 32
 UPPER_BOUND = 8
+HASH_PAIR_CACHE_SIZE = 4096
 
 def parse_proof(value_holder):
     """
@@ -41,6 +41,8 @@ def parse_proof(value_holder):
     :return: A list of hash values.
     """
     value_holder = value_holder.get('IonText')
+    from amazon.ion.simpleion import loads
+
     proof_list = loads(value_holder)
     return proof_list
 
@@ -56,11 +58,81 @@ def parse_block(value_holder):
     :return: The block hash.
     """
     value_holder = value_holder.get('IonText')
+    from amazon.ion.simpleion import loads
+
     block = loads(value_holder)
     block_hash = block.get('blockHash')
     return block_hash
 
 
+def compute_merkle_root(hashes):
+    """
+    Compute the Merkle root of a list of hashes the way QLDB does within a journal block: adjacent hashes are joined
+    pairwise level by level, an odd hash at the end of a level is carried to the next one unchanged.
+
+    :type hashes: list
+    :param hashes: The leaf hashes, in block order.
+
+    :rtype: bytes
+    :return: The root hash, or None when there are no hashes.
+    """
+    level = [bytes(value) for value in hashes]
+    if not level:
+        return None
+    while len(level) > 1:
+        level = [join_hash_pairwise(level[i], level[i + 1]) if i + 1 < len(level) else level[i]
+                 for i in range(0, len(level), 2)]
+    return level[0]
+
+
+def compute_block_hash(block):
+    """
+    Recompute the hash of a journal block from its contents, as the QLDB JournalBlock verification does: the Merkle
+    root of the block revisions is one of the entry hashes, the entries hash is the Merkle root of the entry hashes,
+    and the block hash joins the entries hash with the hash of the previous block.
+
+    :type block: dict
+    :param block: The parsed Block object.
+
+    :rtype: bytes
+    :return: The block hash, or None when the revisions or the entries do not match the entries hash of the block.
+    """
+    entries = set(bytes(entry) for entry in block.get('entriesHashList') or [])
+    revisions = block.get('revisions') or []
+    if revisions:
+        revision_hashes = [revision.get('hash') for revision in revisions]
+        if None in revision_hashes or compute_merkle_root(revision_hashes) not in entries:
+            return None
+    entries_hash = compute_merkle_root(block.get('entriesHashList') or [])
+    if entries_hash is None or block.get('entriesHash') is None or entries_hash != bytes(block.get('entriesHash')):
+        return None
+    return join_hash_pairwise(entries_hash, bytes(block.get('previousBlockHash') or b''))
+
+
+def parse_block_contents(value_holder):
+    """
+    Parse the Block object returned by QLDB and retrieve the block hash along with the revision hashes it contains.
+
+    Only the block hash is covered by the digest proof, so revision hashes are only returned when the block hash
+    recomputed from the revisions and entries matches the one returned.
+
+    :type value_holder: dict
+    :param value_holder: A structure containing an Ion string value.
+
+    :rtype: tuple
+    :return: The block hash and a set of the revision hashes committed in the block, empty when the block contents
+             do not match its hash.
+    """
+    from amazon.ion.simpleion import loads
+
+    block = loads(value_holder.get('IonText'))
+    block_hash = block.get('blockHash')
+    if compute_block_hash(block) != bytes(block_hash):
+        print('Block contents do not match the block hash, none of its revisions can be verified')
+        return block_hash, set()
+    return block_hash, set(bytes(revision.get('hash')) for revision in block.get('revisions') or [])
+
+
 def flip_random_bit(original):
     """
     Flip a single random bit in the given hash value.
@@ -187,3 +259,82 @@ def verify_document(document_hash, digest, proof):
     candidate_digest = build_candidate_digest(proof, document_hash)
     return digest == candidate_digest
 
+
+class HashPairCache:
+    """
+    Bounded LRU cache of Merkle tree nodes, keyed by the ordered pair of hashes the node was joined from.
+
+    Proofs for revisions covered by the same digest share most of their upper tree nodes, so once two proof paths
+    converge every remaining join is served from the cache instead of being hashed again.
+    """
+
+    def __init__(self, max_size=HASH_PAIR_CACHE_SIZE):
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._nodes = OrderedDict()
+
+    def join(self, hash1, hash2):
+        """
+        Same contract as :func:`join_hash_pairwise`, reusing a previously computed node when possible.
+
+        :type hash1: bytes
+        :param hash1: Hash value to concatenate.
+
+        :type hash2: bytes
+        :param hash2: Hash value to concatenate.
+
+        :rtype: bytes
+        :return: The new hash value generated from concatenated hash values.
+        """
+        if len(hash1) == 0:
+            return hash2
+        if len(hash2) == 0:
+            return hash1
+
+        # The join is order independent, so both orderings of a pair must map onto the same key.
+        hash1, hash2 = bytes(hash1), bytes(hash2)
+        key = (hash1, hash2) if hash1 <= hash2 else (hash2, hash1)
+        node = self._nodes.get(key)
+        if node is not None:
+            self._nodes.move_to_end(key)
+            self.hits += 1
+            return node
+
+        node = join_hash_pairwise(hash1, hash2)
+        self.misses += 1
+        self._nodes[key] = node
+        if len(self._nodes) > self.max_size:
+            self._nodes.popitem(last=False)
+        return node
+
+
+def verify_documents(document_proofs, digest, cache=None):
+    """
+    Verify many document revisions against the same digest, sharing intermediate Merkle tree nodes between proofs.
+
+    :type document_proofs: list
+    :param document_proofs: A list of (document_hash, proof) tuples, the proof being the Proof object retrieved
+                            from `get_revision`.
+
+    :type digest: bytes
+    :param digest: The SHA-256 hash value representing the ledger digest.
+
+    :type cache: :py:class:`verifier.HashPairCache`
+    :param cache: Optional node cache to reuse across calls, a new one is used when omitted.
+
+    :rtype: tuple
+    :return: A list with the verification result of each pair, in input order, and a dict holding the number of
+             hash operations performed and saved.
+    """
+    if cache is None:
+        cache = HashPairCache()
+    hits, misses = cache.hits, cache.misses
+
+    results = []
+    for document_hash, proof in document_proofs:
+        candidate_digest = reduce(cache.join, parse_proof(proof), document_hash)
+        results.append(digest == candidate_digest)
+
+    stats = {'hash_operations': cache.misses - misses, 'hash_operations_saved': cache.hits - hits}
+    return results, stats
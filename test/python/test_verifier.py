@@ -0,0 +1,79 @@
+# /*
+#  * Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#  * SPDX-License-Identifier: MIT-0
+#  *
+#  * Permission is hereby granted, free of charge, to any person obtaining a copy of this
+#  * software and associated documentation files (the "Software"), to deal in the Software
+#  * without restriction, including without limitation the rights to use, copy, modify,
+#  * merge, publish, distribute, sublicense, and/or sell copies of the Software, and to
+#  * permit persons to whom the Software is furnished to do so.
+#  *
+#  * THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+#  * INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A
+#  * PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+#  * HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+#  * OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+#  * SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+#  */
+
+# Block-mode verification against a GetBlock response of a batch update: one transaction writing three revisions,
+# with four entries in the block.
+#
+# Usage: python -m unittest discover -s test/python
+
+import json
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'sharedFiles', 'python'))
+
+from amazon.ion.simpleion import dumps, loads
+
+from verifier import compute_block_hash, join_hash_pairwise, parse_block_contents
+
+FIXTURE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures', 'get_block_response.json')
+
+
+def load_block_response():
+    with open(FIXTURE) as fixture_file:
+        return json.load(fixture_file)
+
+
+class BlockVerificationTest(unittest.TestCase):
+
+    def setUp(self):
+        self.response = load_block_response()
+        self.block = loads(self.response['Block']['IonText'])
+
+    def test_entries_are_merkle_roots(self):
+        revisions = [bytes(revision['hash']) for revision in self.block['revisions']]
+        entries = [bytes(entry) for entry in self.block['entriesHashList']]
+        # The revisions of the block are one entry, the entries hash is a balanced tree over the four entries
+        revisions_hash = join_hash_pairwise(join_hash_pairwise(revisions[0], revisions[1]), revisions[2])
+        self.assertIn(revisions_hash, entries)
+        self.assertNotIn(revisions[0], entries)
+        self.assertEqual(join_hash_pairwise(join_hash_pairwise(entries[0], entries[1]),
+                                            join_hash_pairwise(entries[2], entries[3])), bytes(self.block['entriesHash']))
+
+    def test_block_hash_is_recomputed(self):
+        self.assertEqual(compute_block_hash(self.block), bytes(self.block['blockHash']))
+
+    def test_every_revision_of_the_block_is_returned(self):
+        block_hash, revision_hashes = parse_block_contents(self.response['Block'])
+        self.assertEqual(bytes(block_hash), bytes(self.block['blockHash']))
+        self.assertEqual(revision_hashes, set(bytes(revision['hash']) for revision in self.block['revisions']))
+
+    def test_altered_revision_is_rejected(self):
+        self.block['revisions'][1]['hash'] = bytes(32)
+        block_hash, revision_hashes = parse_block_contents({'IonText': dumps(self.block, binary=False)})
+        self.assertEqual(revision_hashes, set())
+
+    def test_reordered_entries_are_rejected(self):
+        entries = self.block['entriesHashList']
+        entries[0], entries[2] = entries[2], entries[0]
+        self.assertIsNone(compute_block_hash(self.block))
+
+
+if __name__ == '__main__':
+    unittest.main()